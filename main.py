@@ -6,55 +6,101 @@
     Main entry point for the staging microservice application
 
 """
+import os
 import sys
+import json
 from argparse import ArgumentParser
 from src.staging.staging import Staging
-from src.common.staging_enums import StagingType, WorkflowTypeName
+from src.staging.service import StagingService, parse_stage_request, post_stage_request, get_batch_ret_val
+from src.common.staging_enums import ReturnCodes
 
 if __name__ == '__main__':
     # Main entry point for the staging microservice
     #
     # Args expected:
-    #    --run_id - The ID of the supervisor run request.
+    #    --run_id - The ID(s) of the supervisor run request(s). several runs are staged at once and summarized as JSON on stdout
     #    --type - The type of staging step, either 'initial' or 'final'
     #    --run_dir - The name of the target directory to use for operations
-
-    # create a staging object
-    stage_obj = Staging()
+    #
+    # or to run as a long-running service:
+    #    --service - Serve staging requests over HTTP on --service_host:--service_port
+    #
+    # optionally:
+    #    --workers - The maximum number of runs staged at once
+    #
+    # or to hand the staging step to a running service:
+    #    --service_url - The URL of the staging service, along with the args above
 
     # create a command line parser
     parser = ArgumentParser()
 
     # declare the command params
-    parser.add_argument('--run_id', default=None, help='The run identifier.', type=str, required=True)
-    parser.add_argument('--run_dir', default=None, help='The name of the run directory to use for the staging operations.', type=str, required=True)
-    parser.add_argument('--step_type', default=None, help='The type of staging step, initial or final.', type=str, required=True)
+    parser.add_argument('--run_id', default=[], help='The run identifier(s).', type=str, nargs='+', required=False)
+    parser.add_argument('--run_dir', default='', help='The name of the run directory to use for the staging operations.', type=str, required=False)
+    parser.add_argument('--step_type', default='', help='The type of staging step, initial or final.', type=str, required=False)
     parser.add_argument('--workflow_type', default='CORE', help='The type of workflow, CORE, TOPOLOGY, etc..', type=str, required=False)
+    parser.add_argument('--workers', default=None, help='The maximum number of runs staged at once.', type=int, required=False)
+    parser.add_argument('--service', action='store_true', help='Run as a long-running staging service.')
+    parser.add_argument('--service_host', default=os.getenv('STAGING_SERVICE_HOST', '127.0.0.1'), help='The address the service listens on.',
+                        type=str, required=False)
+    parser.add_argument('--service_port', default=int(os.getenv('STAGING_SERVICE_PORT', '8080')), help='The port the service listens on.',
+                        type=int, required=False)
+    parser.add_argument('--service_url', default=os.getenv('STAGING_SERVICE_URL', ''), help='Send the staging step to the service at this URL.',
+                        type=str, required=False)
 
     # collect the params
     args = parser.parse_args()
 
-    # init the return value
-    ret_val: int = 0
-
-    # validate the inputs
-    if args.run_id != '' and args.run_id != '' and args.step_type != '' and args.workflow_type != '':
-        try:
-            # check to make sure we got a legit staging and workflow types
-            # these will throw exceptions if they are not
-            tmp = StagingType(args.step_type)
-            tmp2 = WorkflowTypeName(args.workflow_type)
-        except Exception:
-            # invalid input types
-            ret_val: int = -2
-    else:
-        # missing 1 or more params
-        ret_val: int = -3
+    # is this the service?
+    if args.service:
+        # create a staging object and connect to the DB now so that the connections are warm for the first request
+        stage_obj = Staging()
+        stage_obj.db_info.connect()
+
+        # serve the staging requests until stopped
+        with StagingService(stage_obj, args.service_host, args.service_port) as service:
+            stage_obj.logger.info('Staging service version %s listening on %s:%s', stage_obj.app_version, args.service_host, args.service_port)
+
+            try:
+                service.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+        # exit normally
+        sys.exit(0)
+
+    # get the staging request
+    request: dict = {'run_ids': args.run_id, 'run_dir': args.run_dir, 'step_type': args.step_type, 'workflow_type': args.workflow_type,
+                     'workers': args.workers}
+
+    # validate the inputs before anything that does I/O
+    ret_val, run_args = parse_stage_request(request)
 
     # should we continue?
     if ret_val == 0:
-        # do the staging
-        ret_val = stage_obj.run(args.run_id, args.run_dir, args.step_type, args.workflow_type)
+        # hand the step to the service if there is one
+        if args.service_url:
+            # get the return codes from the service
+            response: dict = post_stage_request(args.service_url, request)
+
+            ret_val, results = response['ret_val'], response.get('results', {})
+        else:
+            # create a staging object. the DB is not connected to until it is needed
+            stage_obj = Staging()
+
+            # do the staging
+            results = {run_id: int(code) for run_id, code in stage_obj.run_batch(*run_args, workers=args.workers).items()}
+
+            # get the overall return code
+            ret_val = get_batch_ret_val(results)
+
+        # summarize a batch of runs for the caller
+        if len(run_args[0]) > 1:
+            print(json.dumps({'step_type': run_args[2].value, 'run_dir': args.run_dir, 'ret_val': ret_val, 'results': results}))
+
+    # a final stage whose request group was archived by a peer succeeded
+    if ret_val == ReturnCodes.HANDLED_BY_PEER:
+        ret_val = ReturnCodes.EXIT_CODE_SUCCESS
 
     # exit with the final exit code
     sys.exit(ret_val)
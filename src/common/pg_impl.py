@@ -9,6 +9,8 @@
 """
 import json
 
+from psycopg2.extras import Json
+
 from src.common.pg_utils_multi import PGUtilsMultiConnect
 from src.common.logger import LoggingUtil
 
@@ -21,7 +23,10 @@ class PGImplementation(PGUtilsMultiConnect):
         which has all the connection and cursor handling.
     """
 
-    def __init__(self, db_names: tuple, _logger=None, _auto_commit=True):
+    # the sql expression that compares the testing job counts of a run status document named "status"
+    RUN_GROUP_COMPLETE_SQL: str = "COALESCE((status->'Testing Jobs'->>'Total')::int = (status->'Testing Jobs'->>'Complete')::int, false)"
+
+    def __init__(self, db_names: tuple, _logger=None, _auto_commit=True, _lazy_connect=False):
         # if a reference to a logger is passed in, use it
         if _logger is not None:
             # get a handle to a logger
@@ -35,7 +40,8 @@ class PGImplementation(PGUtilsMultiConnect):
                                                    log_file_path=log_path)
 
         # init the base class
-        PGUtilsMultiConnect.__init__(self, 'iRODS.Supervisor.Jobs.PGImplementation', db_names, _logger=self.logger, _auto_commit=_auto_commit)
+        PGUtilsMultiConnect.__init__(self, 'iRODS.Supervisor.Jobs.PGImplementation', db_names, _logger=self.logger, _auto_commit=_auto_commit,
+                                     _lazy_connect=_lazy_connect)
 
     def __del__(self):
         """
@@ -54,10 +60,10 @@ class PGImplementation(PGUtilsMultiConnect):
         """
 
         # create the sql
-        sql: str = f'SELECT public.get_supervisor_run_def_json({run_id})'
+        sql: str = 'SELECT public.get_supervisor_run_def_json($1)'
 
         # get the data
-        ret_val = self.exec_sql('irods-sv', sql)
+        ret_val = self.exec_sql('irods-sv', sql, (run_id,), 'get_run_def')
 
         # return the data
         return ret_val
@@ -70,33 +76,79 @@ class PGImplementation(PGUtilsMultiConnect):
         """
 
         # create the sql
-        sql: str = f"SELECT public.get_run_status_json('{request_group}');"
+        sql: str = 'SELECT public.get_run_status_json($1)'
 
         # get the data
-        ret_val = self.exec_sql('irods-sv', sql)
+        ret_val = self.exec_sql('irods-sv', sql, (request_group,), 'get_run_status')
 
         # return the data
         return ret_val
 
+    def is_run_group_complete(self, request_group: str):
+        """
+        checks if all the testing jobs of a request group are complete.
+
+        only the completion flag is returned rather than the full run status document.
+
+        :return: True if the testing jobs are complete, False if not or -1 on an error.
+        """
+        # create the sql
+        sql: str = f'SELECT {self.RUN_GROUP_COMPLETE_SQL} FROM public.get_run_status_json($1) AS status'
+
+        # get the data
+        ret_val = self.exec_sql('irods-sv', sql, (request_group,), 'is_run_group_complete')
+
+        # return the data
+        return ret_val if ret_val == -1 else ret_val is True
+
+    def get_run_def_and_complete(self, run_id: str) -> tuple:
+        """
+        gets the supervisor run request for the run id passed and whether the testing jobs of its request group are complete
+        in one round trip.
+
+        :return: The run request and the completion flag, each -1 if not found or on an error.
+        """
+        # create the sql, the status is looked up with the request group of the run request
+        sql: str = f'SELECT run_def, {self.RUN_GROUP_COMPLETE_SQL} FROM public.get_supervisor_run_def_json($1) AS run_def, ' \
+                   f'public.get_run_status_json(run_def->>\'request_group\') AS status'
+
+        # get the data
+        ret_val = self.exec_sql_row('irods-sv', sql, (run_id,), 'get_run_def_and_complete')
+
+        # an error is an empty row
+        if ret_val == -1:
+            ret_val = (None, None)
+
+        # return the data
+        return -1 if ret_val[0] is None else ret_val[0], -1 if ret_val[1] is None else ret_val[1] is True
+
+    def try_lock_run_group(self, request_group: str):
+        """
+        tries to take the lock that allows a single final staging step to archive a request group.
+
+        :return: The connection holding the lock, False if a peer holds it or None on an error.
+        """
+        return self.try_advisory_lock('irods-sv', 'irods-k8s-staging', request_group)
+
+    def unlock_run_group(self, request_group: str, conn):
+        """
+        releases the request group archive lock.
+
+        :return:
+        """
+        self.advisory_unlock('irods-sv', 'irods-k8s-staging', request_group, conn)
+
     def update_run_results(self, run_id: str, results: json):
         """
         gets the supervisor run request for the run id passed.
 
         :return:
         """
-        # if there are test results
-        if results is not None:
-            # make sure the sql lacks single quotes
-            results = json.dumps(results).replace('\'', '')
-
-            # create the sql
-            sql: str = f"SELECT public.update_run_results({run_id}, '{results}')"
-        else:
-            # create the sql
-            sql: str = f"SELECT public.update_run_results({run_id}, null)"
+        # create the sql
+        sql: str = 'SELECT public.update_run_results($1, $2)'
 
-        # get the data
-        ret_val = self.exec_sql('irods-sv', sql)
+        # get the data, the results go through the Json adapter (psycopg2 quotes them into the statement text)
+        ret_val = self.exec_sql('irods-sv', sql, (run_id, Json(results) if results is not None else None), 'update_run_results')
 
         # return the data
         return ret_val
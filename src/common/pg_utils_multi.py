@@ -9,12 +9,45 @@
 """
 
 import os
+import re
+import select
+import sys
+import random
+import threading
 import time
+import weakref
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import psycopg2
+from psycopg2 import extensions, sql
 
 from src.common.logger import LoggingUtil
+from src.common.staging_enums import ReturnCodes
+
+
+class PGSettings:
+    """
+    Class that holds the DB connection pool and retry settings.
+
+    """
+
+    def __init__(self):
+        # get the maximum number of idle connections kept per DB
+        self.pool_size: int = int(os.getenv('DB_POOL_SIZE', '4'))
+
+        # get the number of seconds a connection can be idle before it is checked again
+        self.validation_ttl: float = float(os.getenv('DB_VALIDATION_TTL', '30'))
+
+        # get the number of seconds a single connection attempt can take
+        self.connect_timeout: int = int(os.getenv('DB_CONNECT_TIMEOUT', '10'))
+
+        # get the first and the maximum delay in seconds between connection attempts
+        self.retry_base: float = float(os.getenv('DB_RETRY_BASE', '1'))
+        self.retry_cap: float = float(os.getenv('DB_RETRY_CAP', '30'))
+
+        # get the maximum number of seconds to keep trying to connect
+        self.max_wait: float = float(os.getenv('DB_MAX_WAIT', '300'))
 
 
 class PGUtilsMultiConnect:
@@ -27,13 +60,24 @@ class PGUtilsMultiConnect:
         final environment parameter should be all uppercase.
 
         Please see the get_conn_config() method below for more details.
+
+        Connections are pooled per DB. A pooled connection is only checked
+        before use if it has been idle longer than the validation TTL.
+
+        Connection attempts are retried with exponential backoff and jitter
+        until the maximum wait is reached. If the initial connection can not
+        be made the process exits with ReturnCodes.DB_ERROR.
+
+        With lazy connect no connection is made until the first query, which
+        then fails with an error return if the DB can not be reached.
     """
 
-    def __init__(self, app_name, db_names: tuple, _logger=None, _auto_commit=True):
+    def __init__(self, app_name, db_names: tuple, _logger=None, _auto_commit=True, _lazy_connect=False):
         """
         Entry point for the db connection creation and operations
 
         :param db_names:
+        :param _lazy_connect: Do not connect until the first query.
         """
         # if a reference to a logger passed in use it
         if _logger is not None:
@@ -55,6 +99,21 @@ class PGUtilsMultiConnect:
         # create the named tuple definition for DB info
         self.db_info_tpl: namedtuple = namedtuple('DB_Info', ['name', 'conn_str', 'conn'])
 
+        # create the named tuple definition for an idle pooled connection
+        self.pooled_conn_tpl: namedtuple = namedtuple('Pooled_Conn', ['conn', 'last_used'])
+
+        # the idle connections for each DB, most recently used last
+        self.pools: dict = {}
+
+        # protects the connection pools
+        self.pool_lock = threading.Lock()
+
+        # the names of the statements prepared on each connection
+        self.prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+        # get the pool and connection retry settings
+        self.settings: PGSettings = PGSettings()
+
         # save the DB names for connection/cursor closing on class tear-down
         self.db_names: tuple = db_names
 
@@ -63,11 +122,18 @@ class PGUtilsMultiConnect:
             # get the connection string
             conn_config = self.get_conn_config(db_name)
 
-            # create a temporary tuple to get the discovery process started
+            # create a tuple of the connection details
             temp_tuple: namedtuple = self.db_info_tpl(db_name, conn_config, None)
 
-            # get the connection
-            self.get_db_connection(temp_tuple)
+            # save the connection details and create an empty pool
+            self.dbs.update({db_name: temp_tuple})
+            self.pools.update({db_name: []})
+
+        # connect now unless told to wait for the first query
+        if not _lazy_connect:
+            # giving up on a DB lets the caller reschedule the work
+            if not self.connect():
+                sys.exit(ReturnCodes.DB_ERROR)
 
     def __del__(self):
         """
@@ -82,22 +148,43 @@ class PGUtilsMultiConnect:
 
     def close_conn(self, db_name: str):
         """
-        Closes a DB connection
+        Closes the pooled DB connections
 
         :param db_name:
         :return:
         """
         try:
-            # if there is a connection, close it
-            if self.dbs[db_name].conn is not None:
-                # get the item out of the tuple
-                conn = self.dbs[db_name].conn
-
-                # close it
-                conn.close()
+            # take the connections out of the pool
+            with self.pool_lock:
+                pooled_conns: list = self.pools[db_name]
+                self.pools[db_name] = []
+
+            # close them
+            for pooled_conn in pooled_conns:
+                pooled_conn.conn.close()
         except Exception:
             self.logger.warning('Error detected closing the %s DB connection.', db_name)
 
+    def connect(self) -> bool:
+        """
+        Opens a connection to each DB and adds it to the pool.
+
+        The DBs are connected to at once so that this waits for the slowest DB rather than the sum of them.
+
+        :return: True if all the DBs were connected to.
+        """
+        # connect to all the DBs
+        with ThreadPoolExecutor(max_workers=max(1, len(self.db_names)), thread_name_prefix='db-connect') as executor:
+            connected: list = list(executor.map(self.get_db_connection, self.dbs.values()))
+
+        # report the DBs that could not be reached
+        for db_name, good_conn in zip(self.dbs, connected):
+            if not good_conn:
+                self.logger.error('DB Connection to %s could not be established within %s seconds.', db_name, self.settings.max_wait)
+
+        # return to the caller
+        return all(connected)
+
     @staticmethod
     def get_conn_config(db_name: str) -> str:
         """
@@ -124,57 +211,149 @@ class PGUtilsMultiConnect:
 
     def get_db_connection(self, db_info: namedtuple) -> bool:
         """
-        Gets a connection to the DB. performs a check to continue trying until
-        a connection is made.
+        Gets a new connection to the DB and adds it to the pool.
 
         :return:
         """
-        # init the connection status indicator
-        good_conn: bool = False
+        # get a new connection
+        conn = self.new_connection(db_info)
 
-        # until forever
-        while not good_conn:
-            try:
-                # check the DB connection
-                good_conn = self.check_db_connection(db_info)
+        # put it in the pool
+        if conn is not None:
+            self.release_conn(db_info.name, conn)
 
-                # try to get a connection if the check failed
-                if not good_conn:
-                    # try to connect to the DB
-                    conn = psycopg2.connect(db_info.conn_str)
+        # return pass/fail flag
+        return conn is not None
+
+    def new_connection(self, db_info: namedtuple, max_wait: float = None):
+        """
+        Creates a new connection to the DB. performs a check to continue trying until
+        a connection is made or the maximum wait is reached.
 
-                    # set the autocommit on the connection
-                    conn.autocommit = self.auto_commit
+        The delay between attempts doubles each time up to the retry cap, with full jitter.
 
-                    # create a new db info tuple
-                    verified_tuple: namedtuple = self.db_info_tpl(db_info.name, db_info.conn_str, conn)
+        :param db_info: The DB connection information.
+        :param max_wait: The maximum number of seconds to keep trying, None for the DB_MAX_WAIT setting.
+        :return: The verified connection, or None if no connection could be made.
+        """
+        # get the time to give up
+        deadline: float = time.monotonic() + (self.settings.max_wait if max_wait is None else max_wait)
 
-                    # check the new DB connection
-                    good_conn = self.check_db_connection(verified_tuple)
+        # init the attempt counter
+        attempt: int = 0
 
-                    # is the connection ok now?
-                    if not good_conn:
-                        self.logger.warning('DB Connection not established (auto commit %s) to %s.', self.auto_commit, db_info.name)
-                    else:
-                        self.logger.debug('DB Connection established (auto commit %s) to %s.', self.auto_commit, db_info.name)
+        # until the deadline
+        while True:
+            # init the connection
+            conn = None
+
+            try:
+                # try to connect to the DB, not waiting past the deadline
+                conn = psycopg2.connect(db_info.conn_str,
+                                        connect_timeout=max(1, int(min(self.settings.connect_timeout, deadline - time.monotonic()))))
+
+                # set the autocommit on the connection
+                conn.autocommit = self.auto_commit
+
+                # check the new DB connection
+                if self.check_db_connection(self.db_info_tpl(db_info.name, db_info.conn_str, conn)):
+                    self.logger.debug('DB Connection established (auto commit %s) to %s.', self.auto_commit, db_info.name)
 
-                        # add the verified connection to the dict
-                        self.dbs.update({db_info.name: verified_tuple})
+                    # return the connection
+                    return conn
 
-                        # no need to continue
-                        break
+                self.logger.warning('DB Connection not established (auto commit %s) to %s.', self.auto_commit, db_info.name)
+
+                # discard the connection
+                conn.close()
 
             except Exception:
                 self.logger.exception('Error getting connection %s.', db_info.name)
-                good_conn = False
 
-            # are we still looking for a connection
-            if good_conn is False:
-                self.logger.error('DB Connection failed to %s. Retrying...', db_info.name)
-                time.sleep(5)
+            # get the backoff delay for this attempt
+            delay: float = random.uniform(0, min(self.settings.retry_cap, self.settings.retry_base * 2 ** attempt))
 
-        # return pass/fail flag
-        return good_conn
+            # give up if the next attempt would start after the deadline
+            if time.monotonic() + delay >= deadline:
+                self.logger.error('DB Connection failed to %s after %s attempt(s). Giving up.', db_info.name, attempt + 1)
+
+                return None
+
+            self.logger.error('DB Connection failed to %s. Retrying in %.1f seconds...', db_info.name, delay)
+
+            # wait and try again
+            time.sleep(delay)
+
+            attempt += 1
+
+    def acquire_conn(self, db_name: str):
+        """
+        Gets a connection from the pool, or a new one if the pool is empty.
+
+        A pooled connection that was used within the validation TTL is returned without a check.
+
+        :param db_name:
+        :return: The connection, or None if no connection could be made.
+        """
+        while True:
+            # get the most recently used idle connection
+            with self.pool_lock:
+                pooled_conn = self.pools[db_name].pop() if self.pools[db_name] else None
+
+            # no idle connections, create one
+            if pooled_conn is None:
+                return self.new_connection(self.dbs[db_name])
+
+            # a recently used connection is trusted
+            if not pooled_conn.conn.closed and time.monotonic() - pooled_conn.last_used < self.settings.validation_ttl:
+                return pooled_conn.conn
+
+            # otherwise check it
+            if self.check_db_connection(self.db_info_tpl(db_name, self.dbs[db_name].conn_str, pooled_conn.conn)):
+                return pooled_conn.conn
+
+            self.logger.debug('Discarding a stale pooled DB connection to %s.', db_name)
+
+            # discard the bad connection and try the next one
+            self.discard_conn(pooled_conn.conn)
+
+    def release_conn(self, db_name: str, conn):
+        """
+        Returns a connection to the pool. connections are closed if they are broken or the pool is full.
+
+        :param db_name:
+        :param conn:
+        :return:
+        """
+        # broken connections are not reused
+        if conn.closed:
+            return
+
+        # clear out a failed transaction
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+            conn.rollback()
+
+        # put the connection in the pool if there is room
+        with self.pool_lock:
+            if len(self.pools[db_name]) < self.settings.pool_size:
+                self.pools[db_name].append(self.pooled_conn_tpl(conn, time.monotonic()))
+
+                return
+
+        # otherwise close it
+        self.discard_conn(conn)
+
+    def discard_conn(self, conn):
+        """
+        Closes a connection that is no longer needed.
+
+        :param conn:
+        :return:
+        """
+        try:
+            conn.close()
+        except Exception:
+            self.logger.debug('Error closing a discarded DB connection.')
 
     def check_db_connection(self, db_info: namedtuple) -> bool:
         """
@@ -230,75 +409,342 @@ class PGUtilsMultiConnect:
         # return to the caller
         return ret_val
 
-    def exec_sql(self, db_name: str, sql_stmt: str):
+    def exec_sql(self, db_name: str, sql_stmt: str, params: tuple = None, stmt_name: str = None):
         """
-        Executes a sql statement.
+        Executes a sql statement and returns the first column of its one and only row.
 
         :param db_name:
         :param sql_stmt:
-        :return:
+        :param params: The statement parameters.
+        :param stmt_name: The name to prepare the statement under.
+        :return: The value, or -1 on an error or an empty result.
         """
-        # init the return
-        ret_val = None
+        # get the row
+        ret_val = self.exec_sql_row(db_name, sql_stmt, params, stmt_name)
 
-        # get the appropriate db info object
-        db_info = self.dbs[db_name]
+        # get the first column
+        if ret_val != -1:
+            ret_val = ret_val[0]
 
-        # insure we have a valid DB connection
-        success = self.get_db_connection(db_info)
+        # return to the caller
+        return ret_val
 
-        # did we get a connection
-        if success:
-            # init the cursor
-            cursor = None
+    def exec_sql_batch(self, db_name: str, queries: list, stmt_name: str = None) -> list:
+        """
+        Executes several single value queries in one round trip.
 
-            try:
-                # make sure the latest db_info is used
-                db_info = self.dbs[db_name]
+        Each query is a (sql, params) tuple whose sql returns a single value, e.g. SELECT public.some_function($1).
+        The queries are combined into one SELECT of scalar sub-queries with their parameters renumbered.
 
-                # get a cursor
-                cursor = db_info.conn.cursor()
+        :param db_name:
+        :param queries: The (sql, params) tuples.
+        :param stmt_name: The name to prepare the combined statement under.
+        :return: A list of the query values, with -1 for an empty value, or -1 on an error.
+        """
+        # init the combined sql parts and parameters
+        sub_queries: list = []
+        batch_params: list = []
+
+        for sql_stmt, params in queries:
+            # get the offset of this query's parameters
+            offset: int = len(batch_params)
+
+            # renumber the parameter placeholders
+            sql_stmt = re.sub(r'\$(\d+)', lambda match, offset=offset: f'${int(match.group(1)) + offset}', sql_stmt)
+
+            # add the query as a sub-query
+            sub_queries.append(f'({sql_stmt})')
+
+            # add the parameters
+            batch_params.extend(params or ())
+
+        # execute the combined query
+        ret_val = self.exec_sql_row(db_name, f"SELECT {', '.join(sub_queries)}", tuple(batch_params), stmt_name)
 
-                # execute the sql
-                cursor.execute(sql_stmt)
+        # an empty value is a -1 like any single query
+        if ret_val != -1:
+            ret_val = [-1 if value is None else value for value in ret_val]
+
+        # return to the caller
+        return ret_val
+
+    def exec_sql_row(self, db_name: str, sql_stmt: str, params: tuple = None, stmt_name: str = None):
+        """
+        Executes a sql statement and returns its one and only row.
 
-                # get the returned value
-                ret_val = cursor.fetchone()
+        Parameters fill the $1, $2... placeholders of the statement. if a statement name is given the statement is
+        prepared once per connection and executed by name. note that psycopg2 has no server side binding: the values are
+        quoted and put into the statement text on the client, so large values (e.g. the results JSON) are still sent as
+        escaped SQL literals. preparing only saves the server from parsing and planning the statement again.
+
+        If the connection turns out to be broken the statement is retried once on a new connection.
+
+        :param db_name:
+        :param sql_stmt:
+        :param params: The statement parameters.
+        :param stmt_name: The name to prepare the statement under.
+        :return: The row, or -1 on an error or an empty result.
+        """
+        # init the return
+        ret_val = -1
+
+        # get a connection
+        conn = self.acquire_conn(db_name)
+
+        # no connection could be made
+        if conn is None:
+            return ret_val
+
+        # try the statement, allowing one retry on a broken connection
+        for attempt in range(2):
+            try:
+                # get a cursor
+                with conn.cursor() as cursor:
+                    # execute the sql
+                    if stmt_name is None:
+                        cursor.execute(*self.get_pyformat_sql(sql_stmt, params))
+                    else:
+                        self.exec_prepared(conn, cursor, stmt_name, sql_stmt, params)
+
+                    # get the returned value
+                    ret_val = cursor.fetchone()
 
                 # trap the return
-                if ret_val is None or ret_val[0] is None:
+                if ret_val is None or all(value is None for value in ret_val):
                     # specify a return code on an empty result
                     ret_val = -1
-                else:
-                    # get the one and only record of json
-                    ret_val = ret_val[0]
+
+                # no need to continue
+                break
+
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # only a closed connection is a broken connection, anything else is a statement error
+                if not conn.closed or attempt > 0:
+                    self.logger.exception("Error detected executing SQL: %s.", sql_stmt)
+
+                    # set the error code
+                    ret_val = -1
+
+                    break
+
+                self.logger.warning('DB connection to %s was lost. Retrying the SQL on a new connection.', db_name)
+
+                # get a new connection
+                conn = self.new_connection(self.dbs[db_name])
+
+                # no connection could be made
+                if conn is None:
+                    return ret_val
 
             except Exception:
                 self.logger.exception("Error detected executing SQL: %s.", sql_stmt)
 
                 # set the error code
                 ret_val = -1
-            finally:
-                # in there is a cursor, close it
-                if cursor is not None:
-                    # close it
-                    cursor.close()
 
+                break
+
+        # return the connection to the pool
+        self.release_conn(db_name, conn)
+
+        # return to the caller
+        return ret_val
+
+    @staticmethod
+    def get_pyformat_sql(sql_stmt: str, params: tuple) -> tuple:
+        """
+        Converts a statement with $1, $2... parameter placeholders to the %(name)s placeholders of an unprepared execute.
+
+        :param sql_stmt: The sql of the statement, with $1, $2... parameter placeholders.
+        :param params: The statement parameters.
+        :return: The sql and the parameters keyed by placeholder number, or the statement as is if it has no parameters.
+        """
+        # without parameters psycopg2 leaves the sql untouched
+        if not params:
+            return sql_stmt, params
+
+        # escape any literal percent signs and convert the placeholders
+        sql_stmt = re.sub(r'\$(\d+)', r'%(\1)s', sql_stmt.replace('%', '%%'))
+
+        # return to the caller
+        return sql_stmt, {str(index): param for index, param in enumerate(params, start=1)}
+
+    def exec_prepared(self, conn, cursor, stmt_name: str, sql_stmt: str, params: tuple):
+        """
+        Executes a named statement, preparing it first if this connection has not seen it.
+
+        The parameters of the EXECUTE are quoted into its text by psycopg2 on the client, they are not bound on the server.
+
+        :param conn: The connection the cursor belongs to.
+        :param cursor: The cursor to execute on.
+        :param stmt_name: The name of the prepared statement.
+        :param sql_stmt: The sql of the statement, with $1, $2... parameter placeholders.
+        :param params: The statement parameters.
+        :return:
+        """
+        # get the statements prepared on this connection
+        prepared: set = self.prepared.setdefault(conn, set())
+
+        # prepare the statement once per connection
+        if stmt_name not in prepared:
+            cursor.execute(f'PREPARE {stmt_name} AS {sql_stmt}')
+
+            prepared.add(stmt_name)
+
+        # execute it with the parameters
+        if params:
+            cursor.execute(f"EXECUTE {stmt_name} ({', '.join(['%s'] * len(params))})", params)
         else:
-            # set the error code
-            ret_val = -1
+            cursor.execute(f'EXECUTE {stmt_name}')
+
+    def try_advisory_lock(self, db_name: str, namespace: str, key: str):
+        """
+        Tries to take a session level advisory lock without waiting.
+
+        The lock is held by a connection that is kept out of the pool until advisory_unlock() is called.
+        if the process dies the connection closes and the lock is released.
+
+        :param db_name:
+        :param namespace: The name of the application the key belongs to.
+        :param key: The name of the locked item.
+        :return: The connection holding the lock, False if someone else holds it or None on an error.
+        """
+        # get a connection
+        conn = self.acquire_conn(db_name)
+
+        # no connection could be made
+        if conn is None:
+            return None
+
+        try:
+            # try to take the lock
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_lock(hashtext(%s), hashtext(%s))', (namespace, key))
+
+                locked: bool = cursor.fetchone()[0]
+        except Exception:
+            self.logger.exception('Error detected taking the advisory lock %s/%s.', namespace, key)
+
+            # return the connection to the pool
+            self.release_conn(db_name, conn)
+
+            return None
+
+        # the connection is kept while the lock is held
+        if locked:
+            return conn
+
+        # return the connection to the pool
+        self.release_conn(db_name, conn)
+
+        # return to the caller
+        return False
+
+    def advisory_unlock(self, db_name: str, namespace: str, key: str, conn):
+        """
+        Releases an advisory lock taken with try_advisory_lock().
+
+        :param db_name:
+        :param namespace: The name of the application the key belongs to.
+        :param key: The name of the locked item.
+        :param conn: The connection holding the lock.
+        :return:
+        """
+        try:
+            # release the lock
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(hashtext(%s), hashtext(%s))', (namespace, key))
+        except Exception:
+            self.logger.exception('Error detected releasing the advisory lock %s/%s.', namespace, key)
+
+            # the lock goes with the connection
+            self.discard_conn(conn)
+
+            return
+
+        # return the connection to the pool
+        self.release_conn(db_name, conn)
+
+    def listen(self, db_name: str, channel: str, max_wait: float = None):
+        """
+        Opens a dedicated connection that is subscribed to a notification channel.
+
+        The connection is not pooled. it must be closed with discard_conn() when no longer needed.
+
+        :param db_name:
+        :param channel: The notification channel.
+        :param max_wait: The maximum number of seconds to keep trying to connect, None for the DB_MAX_WAIT setting.
+        :return: The listening connection, or None if the subscription failed.
+        """
+        # get a new connection
+        conn = self.new_connection(self.dbs[db_name], max_wait)
+
+        # no connection could be made
+        if conn is None:
+            return None
+
+        try:
+            # notifications are only delivered outside a transaction
+            conn.autocommit = True
+
+            # subscribe to the channel
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel)))
+        except Exception:
+            self.logger.exception('Error detected listening on the %s channel of %s.', channel, db_name)
+
+            # discard the connection
+            self.discard_conn(conn)
+
+            return None
+
+        # return to the caller
+        return conn
+
+    def wait_notify(self, conn, timeout: float):
+        """
+        Waits for notifications on a listening connection.
+
+        :param conn: The connection from listen().
+        :param timeout: The maximum number of seconds to wait.
+        :return: The payloads received, an empty list on a timeout or None if the connection is broken.
+        """
+        try:
+            # wait for the connection to become readable and read what arrived
+            if select.select([conn], [], [], max(0.0, timeout)) != ([], [], []):
+                conn.poll()
+
+            # get the payloads
+            ret_val: list = [notify.payload for notify in conn.notifies]
+
+            # they have been handled
+            conn.notifies.clear()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError, OSError):
+            self.logger.warning('Listening DB connection was lost.')
+
+            # the connection is broken
+            ret_val = None
 
         # return to the caller
         return ret_val
 
     def commit(self, db_name: str):
         """
-        issues a transaction commit
+        issues a transaction commit on the pooled connections
+
+        A statement's connection goes back to the pool once the statement completes, so with auto commit off its
+        transaction is committed here. Unlike a single shared connection, connections that are checked out at the time
+        (e.g. one holding an advisory lock or running a statement on another thread) are not committed.
 
         :param db_name:
         :return:
         """
-        # if this connection is set to not auto commit
-        if not self.dbs[db_name].conn.autocommit:
-            # issue the commit
-            self.dbs[db_name].conn.commit()
+        # get the idle connections
+        with self.pool_lock:
+            conns: list = [pooled_conn.conn for pooled_conn in self.pools[db_name]]
+
+        for conn in conns:
+            # if this connection is set to not auto commit
+            if not conn.autocommit:
+                # issue the commit
+                conn.commit()
@@ -58,3 +58,22 @@ class ReturnCodes(int, Enum):
     EXCEPTION_RUN_PROCESSING = -99
     ERROR_TEST_FILE = -98
     ERROR_NO_RUN_DIR = -97
+    HANDLED_BY_PEER = -96
+
+
+class ArchiveFormat(str, Enum):
+    """
+    Class enums for the test results archive formats
+
+    """
+    # zip with deflate compression
+    ZIP_DEFLATE = 'zip'
+
+    # zip with no compression
+    ZIP_STORE = 'zip-store'
+
+    # gzip compressed tar
+    TAR_GZ = 'tar.gz'
+
+    # zstandard compressed tar
+    TAR_ZST = 'tar.zst'
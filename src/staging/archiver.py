@@ -0,0 +1,872 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Archive functionality for the staging microservice.
+
+    Zip members are compressed in a pool of worker processes and the
+    pre-compressed entries are assembled into a standard (Zip64 capable)
+    zip file. Tar archives are compressed as a single gzip or zstandard stream.
+
+    Zip archives can also be built from member archives that were created
+    earlier (one per executor results directory). Their entries are copied
+    into the final archive as-is, without being compressed again.
+
+    Archives are written through large buffers to a temporary name on the
+    target file system, synced once and then renamed into place, so an
+    interrupted write never leaves a truncated archive behind.
+
+    A JSON manifest of the zip members and the location of their data is
+    written next to the archive so single members can be read without
+    scanning the archive. e.g.
+
+        python -m src.staging.archiver <archive file> <member name> <output file>
+"""
+import errno
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+import shutil
+import struct
+import tarfile
+import tempfile
+import time
+import uuid
+import zlib
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from src.common.logger import LoggingUtil
+from src.common.staging_enums import ArchiveFormat, StagingTestExecutor
+
+# zstandard is only needed for the tar.zst format
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the size of the chunks used when reading and writing member data
+CHUNK_SIZE: int = 1024 * 1024
+
+# the default size of the write buffer for archive files
+WRITE_BUFFER_SIZE: int = 8 * 1024 * 1024
+
+# the maximum number of bytes copied by the kernel per call
+KERNEL_COPY_SIZE: int = 1024 * 1024 * 1024
+
+# the suffix of files that are still being written. these are never archived
+PARTIAL_SUFFIX: str = '.partial'
+
+# the prefix of the scratch directories that hold compressed members while an archive is built. these are never archived
+SCRATCH_PREFIX: str = '.archive-'
+
+# values at or above these limits require zip64 records
+ZIP64_LIMIT: int = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT: int = 0xFFFF
+
+# the zip version needed to extract (2.0 for deflate, 4.5 for zip64)
+ZIP_VERSION: int = 20
+ZIP64_VERSION: int = 45
+
+# the "made by" host system id (3 = unix) so that file modes are honored
+ZIP_CREATE_SYSTEM: int = 3
+
+# the general purpose flag that declares a UTF-8 member name
+ZIP_UTF8_FLAG: int = 0x800
+
+# the zip record layouts
+LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+END_OF_CENTRAL_DIR = struct.Struct('<4sHHHHLLH')
+ZIP64_END_OF_CENTRAL_DIR = struct.Struct('<4sQHHLLQQQQ')
+ZIP64_END_OF_CENTRAL_DIR_LOCATOR = struct.Struct('<4sLQL')
+
+# the file extension for each archive format
+ARCHIVE_EXTENSIONS: dict = {ArchiveFormat.ZIP_DEFLATE: 'zip', ArchiveFormat.ZIP_STORE: 'zip', ArchiveFormat.TAR_GZ: 'tar.gz',
+                            ArchiveFormat.TAR_ZST: 'tar.zst'}
+
+# the archive formats that are zip archives
+ZIP_FORMATS: tuple = (ArchiveFormat.ZIP_DEFLATE, ArchiveFormat.ZIP_STORE)
+
+# the default compression level for each archive format
+DEFAULT_LEVELS: dict = {ArchiveFormat.ZIP_DEFLATE: 6, ArchiveFormat.ZIP_STORE: 0, ArchiveFormat.TAR_GZ: 6, ArchiveFormat.TAR_ZST: 3}
+
+# files with these extensions are already compressed and are stored as-is in zip archives
+STORED_EXTENSIONS: tuple = ('.gz', '.tgz', '.zip', '.zst', '.bz2', '.xz', '.lz4', '.7z', '.jar', '.png', '.jpg', '.jpeg')
+
+# the extension of the archive manifest file
+MANIFEST_EXTENSION: str = 'manifest.json'
+
+# the name of the directory (below the run directory) that holds the member archives
+MEMBER_ARCHIVE_DIR: str = '.member-archives'
+
+# the start method of the compression worker processes. staging steps run other threads (deletions, batches, service requests),
+# and forking a process with threads can deadlock the child, so the workers come from a fork server where there is one
+POOL_START_METHOD: str = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# the description of an archive member. the member data is compress_size bytes found at data_offset in data_path
+ArchiveMember = namedtuple('ArchiveMember', ['arc_name', 'data_path', 'method', 'crc', 'size', 'compress_size', 'mtime', 'mode', 'data_offset'],
+                           defaults=(0,))
+
+
+def compress_member(src_path: str, arc_name: str, tmp_dir: str, level: int, store: bool) -> ArchiveMember:
+    """
+    Deflates a single file into a temporary file. this runs in a worker process.
+
+    The file is stored as-is if requested or if compression does not make it smaller.
+
+    :param src_path: The path of the file to compress.
+    :param arc_name: The name of the member in the archive.
+    :param tmp_dir: The directory for the compressed output.
+    :param level: The compression level.
+    :param store: Flag to store the file without compression.
+
+    :return: The description of the compressed member.
+    """
+    # get the file details
+    stat = os.stat(src_path)
+
+    # init the running checksum and size
+    crc: int = 0
+    size: int = 0
+
+    # if the file is to be stored only the checksum is needed
+    if store:
+        with open(src_path, 'rb') as in_fp:
+            while chunk := in_fp.read(CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+
+        return ArchiveMember(arc_name, src_path, zipfile.ZIP_STORED, crc, size, size, stat.st_mtime, stat.st_mode)
+
+    # create a raw deflate stream (no zlib header) as required by the zip format
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    # create the temporary output file
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+
+    # stream the file through the compressor
+    with open(src_path, 'rb') as in_fp, os.fdopen(fd, 'wb') as out_fp:
+        while chunk := in_fp.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            out_fp.write(compressor.compress(chunk))
+
+        # write out the remainder
+        out_fp.write(compressor.flush())
+
+        # get the compressed size
+        compress_size: int = out_fp.tell()
+
+    # if compression did not help store the original data instead
+    if compress_size >= size:
+        os.unlink(tmp_path)
+
+        return ArchiveMember(arc_name, src_path, zipfile.ZIP_STORED, crc, size, size, stat.st_mtime, stat.st_mode)
+
+    # return the compressed member
+    return ArchiveMember(arc_name, tmp_path, zipfile.ZIP_DEFLATED, crc, size, compress_size, stat.st_mtime, stat.st_mode)
+
+
+class ZipArchiveWriter:
+    """
+    Class that writes pre-compressed members into a zip file.
+
+    """
+
+    def __init__(self, fp):
+        """
+        :param fp: The open (binary) file object to write the archive to.
+        """
+        # save the output file
+        self.fp = fp
+
+        # the current write offset in the archive
+        self.offset: int = 0
+
+        # the member descriptions with their local header and data offsets
+        self.entries: list = []
+
+    def write(self, data: bytes):
+        """
+        Writes data to the archive and tracks the offset.
+
+        :param data: The data to write.
+        :return:
+        """
+        self.fp.write(data)
+        self.offset += len(data)
+
+    @staticmethod
+    def dos_date_time(mtime: float) -> tuple:
+        """
+        Converts a timestamp into the zip (MS-DOS) date and time values.
+
+        :param mtime: The timestamp.
+        :return: The date and time values.
+        """
+        # get the local time, the zip format does not go earlier than 1980
+        tm = time.localtime(max(mtime, 315532800))
+
+        # return to the caller
+        return (max(tm.tm_year, 1980) - 1980) << 9 | tm.tm_mon << 5 | tm.tm_mday, tm.tm_hour << 11 | tm.tm_min << 5 | tm.tm_sec // 2
+
+    def add(self, member: ArchiveMember):
+        """
+        Adds a member to the archive. the member data is streamed from its data path.
+
+        :param member: The member to add.
+        :return:
+        """
+        # get the member name
+        name: bytes = member.arc_name.encode('utf-8')
+
+        # set the utf-8 flag if needed
+        flags: int = ZIP_UTF8_FLAG if not member.arc_name.isascii() else 0
+
+        # get the member date and time
+        dos_date, dos_time = self.dos_date_time(member.mtime)
+
+        # the local header must carry both sizes in a zip64 extra field when either overflows
+        if member.size >= ZIP64_LIMIT or member.compress_size >= ZIP64_LIMIT:
+            extra: bytes = struct.pack('<HHQQ', 1, 16, member.size, member.compress_size)
+            size, compress_size, version = ZIP64_LIMIT, ZIP64_LIMIT, ZIP64_VERSION
+        else:
+            extra: bytes = b''
+            size, compress_size, version = member.size, member.compress_size, ZIP_VERSION
+
+        # save the location of the local header
+        header_offset: int = self.offset
+
+        # write out the local header
+        self.write(LOCAL_HEADER.pack(b'PK\x03\x04', version, flags, member.method, dos_time, dos_date, member.crc, compress_size, size, len(name),
+                                     len(extra)) + name + extra)
+
+        # save the member and the location of its header and data
+        self.entries.append((member, header_offset, self.offset))
+
+        # stream in the member data
+        if member.data_path is not None:
+            with open(member.data_path, 'rb') as in_fp:
+                # go to the start of the member data
+                in_fp.seek(member.data_offset)
+
+                # init the count of bytes to copy
+                remaining: int = member.compress_size
+
+                # copy the data
+                while remaining > 0 and (chunk := in_fp.read(min(CHUNK_SIZE, remaining))):
+                    self.write(chunk)
+                    remaining -= len(chunk)
+
+            # the data must be complete
+            if remaining > 0:
+                raise OSError(f'Unexpected end of data for {member.arc_name} in {member.data_path}.')
+
+    def close(self):
+        """
+        Writes out the central directory and the end records.
+
+        :return:
+        """
+        # save the start of the central directory
+        cd_offset: int = self.offset
+
+        # write a central directory record for each member
+        for member, header_offset, _ in self.entries:
+            # get the member name
+            name: bytes = member.arc_name.encode('utf-8')
+
+            # set the utf-8 flag if needed
+            flags: int = ZIP_UTF8_FLAG if not member.arc_name.isascii() else 0
+
+            # get the member date and time
+            dos_date, dos_time = self.dos_date_time(member.mtime)
+
+            # the zip64 extra field only carries the values that overflow, in this order
+            zip64_fields: list = [value for value in (member.size, member.compress_size, header_offset) if value >= ZIP64_LIMIT]
+
+            # build the extra field
+            extra: bytes = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+
+            # get the extract version
+            version: int = ZIP64_VERSION if zip64_fields else ZIP_VERSION
+
+            # set the unix mode and the msdos directory bit
+            external_attr: int = (member.mode & 0xFFFF) << 16 | (0x10 if member.arc_name.endswith('/') else 0)
+
+            # write out the record
+            self.write(CENTRAL_HEADER.pack(b'PK\x01\x02', ZIP_CREATE_SYSTEM << 8 | ZIP64_VERSION, version, flags, member.method, dos_time, dos_date,
+                                           member.crc, min(member.compress_size, ZIP64_LIMIT), min(member.size, ZIP64_LIMIT), len(name),
+                                           len(extra), 0, 0, 0, external_attr, min(header_offset, ZIP64_LIMIT)) + name + extra)
+
+        # get the central directory size and the member count
+        cd_size: int = self.offset - cd_offset
+        count: int = len(self.entries)
+
+        # write out the zip64 end records if needed
+        if count >= ZIP64_COUNT_LIMIT or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+            # save the location of the zip64 end record
+            zip64_offset: int = self.offset
+
+            # write out the zip64 end record and its locator
+            self.write(ZIP64_END_OF_CENTRAL_DIR.pack(b'PK\x06\x06', ZIP64_END_OF_CENTRAL_DIR.size - 12, ZIP_CREATE_SYSTEM << 8 | ZIP64_VERSION,
+                                                     ZIP64_VERSION, 0, 0, count, count, cd_size, cd_offset))
+            self.write(ZIP64_END_OF_CENTRAL_DIR_LOCATOR.pack(b'PK\x06\x07', 0, zip64_offset, 1))
+
+        # write out the end record
+        self.write(END_OF_CENTRAL_DIR.pack(b'PK\x05\x06', 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+                                           min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0))
+
+    def get_manifest(self) -> list:
+        """
+        Gets the manifest entries of the file members in the archive.
+
+        :return: A list of member details, including the offset of the (compressed) member data.
+        """
+        # init the return
+        ret_val: list = []
+
+        for member, _, data_offset in self.entries:
+            # directories have no data
+            if not member.arc_name.endswith('/'):
+                # member names are <run id>/<executor>/...
+                parts: list = member.arc_name.split('/')
+
+                # save the member details
+                ret_val.append({'path': member.arc_name,
+                                'executor': parts[1] if len(parts) > 2 and parts[1] in StagingTestExecutor.__members__ else None,
+                                'size': member.size, 'compress_size': member.compress_size, 'offset': data_offset, 'method': member.method,
+                                'crc': member.crc, 'mtime': int(member.mtime)})
+
+        # return to the caller
+        return ret_val
+
+
+class ArchiveBuilder:
+    """
+    Class that builds the test results archive using multiple cores.
+
+    """
+
+    def __init__(self, workers: int = 0, level: int = None, archive_format: ArchiveFormat = ArchiveFormat.ZIP_DEFLATE,
+                 stored_extensions: tuple = STORED_EXTENSIONS, write_buffer: int = WRITE_BUFFER_SIZE, _logger=None):
+        """
+        :param workers: The number of compression workers, 0 uses the CPU count.
+        :param level: The compression level, None uses the default for the format.
+        :param archive_format: The archive format.
+        :param stored_extensions: The extensions of files that are stored without compression in zip archives.
+        :param write_buffer: The size of the archive file write buffer.
+        :param _logger: A logger to use.
+        """
+        # if a reference to a logger is passed in, use it
+        if _logger is not None:
+            # get a handle to a logger
+            self.logger = _logger
+        else:
+            # get the log level and directory from the environment.
+            log_level, log_path = LoggingUtil.prep_for_logging()
+
+            # create a logger
+            self.logger = LoggingUtil.init_logging("iRODS.Staging.ArchiveBuilder", level=log_level, line_format='medium', log_file_path=log_path)
+
+        # save the number of workers
+        self.workers: int = workers if workers > 0 else (os.cpu_count() or 1)
+
+        # tar.zst needs the optional zstandard package
+        if archive_format == ArchiveFormat.TAR_ZST and zstandard is None:
+            self.logger.warning('The zstandard package is not installed, using the %s archive format.', ArchiveFormat.TAR_GZ.value)
+
+            archive_format = ArchiveFormat.TAR_GZ
+
+        # save the archive format
+        self.archive_format: ArchiveFormat = archive_format
+
+        # save the compression level
+        self.level: int = level if level is not None else DEFAULT_LEVELS[archive_format]
+
+        # save the extensions of files that are not to be compressed
+        self.stored_extensions: tuple = tuple(ext.lower() for ext in stored_extensions)
+
+        # save the write buffer size
+        self.write_buffer: int = max(CHUNK_SIZE, write_buffer)
+
+    @staticmethod
+    def get_members(src_dir: str, exclude: tuple, top_dir: str = None) -> tuple:
+        """
+        Gets the directories and files to archive.
+
+        :param src_dir: The directory to archive. member names are relative to this directory.
+        :param exclude: The paths to leave out of the archive.
+        :param top_dir: The directory to gather members from, defaults to the src_dir.
+
+        :return: A list of directory members and a list of (file path, member name) tuples.
+        """
+        # init the return values
+        dirs: list = []
+        files: list = []
+
+        # get the full paths of the excluded items
+        exclude = {os.path.abspath(path) for path in exclude}
+
+        # walk the directory tree in a repeatable order
+        for root, dir_names, file_names in os.walk(top_dir or src_dir):
+            # prune the excluded directories and the scratch directories left by an interrupted build
+            dir_names[:] = sorted(dir_name for dir_name in dir_names
+                                  if os.path.abspath(os.path.join(root, dir_name)) not in exclude and not dir_name.startswith(SCRATCH_PREFIX))
+
+            # get the relative path of this directory
+            rel_dir: str = os.path.relpath(root, src_dir)
+
+            # add a member for each directory below the top
+            if rel_dir != os.curdir:
+                # get the directory details
+                stat = os.stat(root)
+
+                # save the directory member
+                dirs.append(ArchiveMember(rel_dir.replace(os.sep, '/') + '/', None, zipfile.ZIP_STORED, 0, 0, 0, stat.st_mtime, stat.st_mode))
+
+            # save each regular file
+            for file_name in sorted(file_names):
+                # get the full path to the file
+                file_path: str = os.path.join(root, file_name)
+
+                # skip excluded, partially written and irregular files
+                if os.path.abspath(file_path) not in exclude and not file_name.endswith(PARTIAL_SUFFIX) and os.path.isfile(file_path):
+                    files.append((file_path, os.path.relpath(file_path, src_dir).replace(os.sep, '/')))
+
+        # return to the caller
+        return dirs, files
+
+    def is_zip(self) -> bool:
+        """
+        Determines if the archive format is a zip format.
+
+        :return: True if this builder creates zip archives.
+        """
+        return self.archive_format in ZIP_FORMATS
+
+    def build(self, src_dir: str, base_name: str, exclude: tuple = (), member_archives: dict = None) -> str:
+        """
+        Creates an archive of a directory.
+
+        :param src_dir: The directory to archive.
+        :param base_name: The full path of the archive file to create, minus the format extension.
+        :param exclude: The paths to leave out of the archive.
+        :param member_archives: Zip member archives keyed by the directory they hold. these are only used for zip formats.
+
+        :return: The full path of the archive file.
+        """
+        # get the full archive file name
+        archive_file: str = f'{base_name}.{ARCHIVE_EXTENSIONS[self.archive_format]}'
+
+        # only zip archives can reuse the member archives
+        member_archives = member_archives if member_archives and self.is_zip() else {}
+
+        self.logger.debug('Building %s archive %s from %s, level %s, %s worker(s), %s member archive(s).', self.archive_format.value, archive_file,
+                          src_dir, self.level, self.workers, len(member_archives))
+
+        # gather the members, making sure the archive does not include itself, its manifest or the directories already in member archives
+        dirs, files = self.get_members(src_dir, exclude + (archive_file, get_manifest_file(base_name)) + tuple(member_archives))
+
+        # build the archive in the requested format, zip archives get a manifest
+        if self.is_zip():
+            manifest: list = self.build_zip(archive_file, dirs, files, tuple(member_archives.values()))
+
+            # write out the manifest
+            with atomic_open(get_manifest_file(base_name)) as fp:
+                fp.write(json.dumps({'archive': os.path.basename(archive_file), 'members': manifest}, separators=(',', ':')).encode('utf-8'))
+        else:
+            self.build_tar(src_dir, archive_file, dirs, files)
+
+        self.logger.debug('Archive %s complete. %s files, %s directories.', archive_file, len(files), len(dirs))
+
+        # return the archive path to the caller
+        return archive_file
+
+    def build_member(self, src_dir: str, member_dir: str, base_name: str) -> str:
+        """
+        Creates a zip member archive of a directory below the src_dir. member names are relative to the src_dir
+        so that the member archive can later be merged into the src_dir archive.
+
+        :param src_dir: The directory of the final archive.
+        :param member_dir: The directory to put in the member archive.
+        :param base_name: The full path of the member archive file to create, minus the extension.
+
+        :return: The full path of the member archive file.
+        """
+        # get the full member archive file name
+        archive_file: str = f'{base_name}.zip'
+
+        self.logger.debug('Building member archive %s from %s.', archive_file, member_dir)
+
+        # gather the members
+        dirs, files = self.get_members(src_dir, (archive_file,), member_dir)
+
+        # build the archive
+        self.build_zip(archive_file, dirs, files)
+
+        # return the archive path to the caller
+        return archive_file
+
+    def build_run_members(self, run_dir: str, run_id: str):
+        """
+        Compresses each executor results directory of a run into its own member archive.
+
+        The member archives are merged into the group archive without being compressed again.
+
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param run_id: The ID of the supervisor run request.
+        :return:
+        """
+        # get the member archive directory
+        member_archive_dir: str = os.path.join(run_dir, MEMBER_ARCHIVE_DIR)
+
+        # make sure the directory exists
+        os.makedirs(member_archive_dir, exist_ok=True)
+
+        # for each executor that has results
+        for executor in StagingTestExecutor.__members__:
+            # get the executor results directory
+            executor_dir: str = os.path.join(run_dir, run_id, executor)
+
+            # member archives are only put in place once complete, so one left by an interrupted step is reused
+            if os.path.isfile(os.path.join(member_archive_dir, f'{run_id}.{executor}.zip')):
+                self.logger.info('Using the existing member archive for run_id: %s, executor: %s', run_id, executor)
+            elif os.path.isdir(executor_dir):
+                self.logger.info('Creating member archive for run_id: %s, executor: %s', run_id, executor)
+
+                # build the member archive under a hidden name so a partial archive is never merged
+                member_file: str = self.build_member(run_dir, executor_dir, os.path.join(member_archive_dir, f'.{run_id}.{executor}'))
+
+                # put it in place
+                os.replace(member_file, os.path.join(member_archive_dir, f'{run_id}.{executor}.zip'))
+
+    @staticmethod
+    def read_members(zip_path: str) -> list:
+        """
+        Gets the descriptions of the members of an existing zip archive so that they can be copied as-is.
+
+        :param zip_path: The path of the zip archive.
+
+        :return: The list of archive members.
+        """
+        # init the return
+        ret_val: list = []
+
+        with zipfile.ZipFile(zip_path) as zip_file, open(zip_path, 'rb') as fp:
+            for info in zip_file.infolist():
+                # read the local header to get the name and extra field lengths
+                fp.seek(info.header_offset)
+                header: tuple = LOCAL_HEADER.unpack(fp.read(LOCAL_HEADER.size))
+
+                # save the member, its data follows the local header
+                ret_val.append(ArchiveMember(info.filename, zip_path, info.compress_type, info.CRC, info.file_size, info.compress_size,
+                                             time.mktime(info.date_time + (0, 0, -1)), info.external_attr >> 16,
+                                             info.header_offset + LOCAL_HEADER.size + header[9] + header[10]))
+
+        # return to the caller
+        return ret_val
+
+    def is_stored(self, file_path: str) -> bool:
+        """
+        Determines if a file is to be stored in a zip archive without compression.
+
+        :param file_path: The path of the file.
+        :return: True if the file is not to be compressed.
+        """
+        return self.archive_format == ArchiveFormat.ZIP_STORE or self.level == 0 or file_path.lower().endswith(self.stored_extensions)
+
+    def build_zip(self, archive_file: str, dirs: list, files: list, member_archives: tuple = ()) -> list:
+        """
+        Creates a zip archive, compressing the files in a process pool.
+
+        :param archive_file: The full path of the archive file to create.
+        :param dirs: The directory members.
+        :param files: The (file path, member name) tuples of the files to add.
+        :param member_archives: The zip archives whose members are copied in as-is.
+
+        :return: The manifest entries of the archive.
+        """
+        # create a scratch directory for the compressed members on the same file system as the archive
+        tmp_dir: str = tempfile.mkdtemp(prefix=SCRATCH_PREFIX, dir=os.path.dirname(os.path.abspath(archive_file)))
+
+        try:
+            with atomic_open(archive_file, self.write_buffer) as fp:
+                # create the archive writer
+                writer = ZipArchiveWriter(fp)
+
+                # add the directory members
+                for member in dirs:
+                    writer.add(member)
+
+                # copy in the already compressed members
+                for member_archive in member_archives:
+                    for member in self.read_members(member_archive):
+                        writer.add(member)
+
+                # get the compression arguments
+                args: tuple = ([src_path for src_path, _ in files], [arc_name for _, arc_name in files], repeat(tmp_dir), repeat(self.level),
+                               [self.is_stored(src_path) for src_path, _ in files])
+
+                # compress the files in a process pool, small jobs are done inline
+                if self.workers > 1 and len(files) > 1:
+                    with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(POOL_START_METHOD)) as executor:
+                        self.add_members(writer, executor.map(compress_member, *args, chunksize=max(1, len(files) // (self.workers * 4))))
+                else:
+                    self.add_members(writer, map(compress_member, *args))
+
+                # finish the archive
+                writer.close()
+        finally:
+            # remove the scratch directory
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # return the manifest to the caller
+        return writer.get_manifest()
+
+    def build_tar(self, src_dir: str, archive_file: str, dirs: list, files: list):
+        """
+        Creates a compressed tar archive. zstandard compresses on multiple threads, gzip on one.
+
+        :param src_dir: The directory to archive.
+        :param archive_file: The full path of the archive file to create.
+        :param dirs: The directory members.
+        :param files: The (file path, member name) tuples of the files to add.
+        :return:
+        """
+        with atomic_open(archive_file, self.write_buffer) as fp:
+            # get a compressed stream in the requested format
+            if self.archive_format == ArchiveFormat.TAR_ZST:
+                stream = zstandard.ZstdCompressor(level=self.level, threads=self.workers).stream_writer(fp, closefd=False)
+            else:
+                stream = gzip.GzipFile(filename='', mode='wb', fileobj=fp, compresslevel=self.level)
+
+            with stream, tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar_file:
+                # add the directories
+                for member in dirs:
+                    tar_file.add(os.path.join(src_dir, member.arc_name), arcname=member.arc_name.rstrip('/'), recursive=False)
+
+                # add the files
+                for src_path, arc_name in files:
+                    tar_file.add(src_path, arcname=arc_name, recursive=False)
+
+    @staticmethod
+    def add_members(writer: ZipArchiveWriter, members):
+        """
+        Adds compressed members to the archive as they complete, removing the scratch files along the way.
+
+        :param writer: The archive writer.
+        :param members: An iterable of compressed members.
+        :return:
+        """
+        for member in members:
+            # add the member
+            writer.add(member)
+
+            # remove the compressed scratch file
+            if member.method != zipfile.ZIP_STORED:
+                os.unlink(member.data_path)
+
+
+@contextmanager
+def atomic_open(file_path: str, buffer_size: int = WRITE_BUFFER_SIZE, mode: int = None):
+    """
+    Opens a file for writing that only appears under its name once it is complete.
+
+    The data goes to a temporary file next to the target through a write buffer of the given size. when the block completes
+    the file is synced once and renamed over the target. if the block fails the temporary file is removed.
+
+    :param file_path: The path of the file to write.
+    :param buffer_size: The size of the write buffer.
+    :param mode: The permissions to give the file, None for the defaults.
+
+    :return: A binary file object.
+    """
+    # get a unique temporary name on the same file system as the target
+    tmp_path: str = os.path.join(os.path.dirname(os.path.abspath(file_path)), f'.{os.path.basename(file_path)}.{uuid.uuid4().hex}{PARTIAL_SUFFIX}')
+
+    # create the file with the default permissions
+    fd: int = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+    try:
+        with os.fdopen(fd, 'wb', buffering=buffer_size) as fp:
+            yield fp
+
+            # write out the buffer and sync the data once
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        # set the permissions before the file appears
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+
+        # put it in place
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        # remove the partial file
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+        raise
+
+
+def kernel_copy(src_fd: int, dst_fd: int) -> bool:
+    """
+    Copies the rest of a file with copy_file_range() or sendfile() so that the data does not pass through user space.
+
+    :param src_fd: The file descriptor to copy from.
+    :param dst_fd: The file descriptor to copy to.
+
+    :return: True if the file was copied, False if the kernel can not copy between these files. nothing is copied in that case.
+    """
+    # get the kernel copy calls available on this platform
+    copiers: list = []
+
+    if hasattr(os, 'copy_file_range'):
+        copiers.append(lambda: os.copy_file_range(src_fd, dst_fd, KERNEL_COPY_SIZE))
+
+    if sys.platform.startswith('linux'):
+        copiers.append(lambda: os.sendfile(dst_fd, src_fd, None, KERNEL_COPY_SIZE))
+
+    for copier in copiers:
+        # init the number of bytes copied
+        copied: int = 0
+
+        try:
+            # copy until the end of the file
+            while True:
+                count: int = copier()
+
+                if count == 0:
+                    return True
+
+                copied += count
+        except OSError as exc:
+            # only fall back if the call is not supported for these files and nothing was copied yet
+            if copied or exc.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF):
+                raise
+
+    # return to the caller
+    return False
+
+
+def copy_file(src_path: str, dst_path: str, buffer_size: int = WRITE_BUFFER_SIZE, mode: int = None):
+    """
+    Copies a file so that the target appears complete or not at all.
+
+    The data is copied by the kernel into a temporary file that is synced once and renamed into place. where the kernel
+    can not copy between the files, the data goes through a buffer of the given size.
+
+    :param src_path: The path of the file to copy.
+    :param dst_path: The path of the copy.
+    :param buffer_size: The size of the read and write buffers.
+    :param mode: The permissions to give the copy, None for the defaults.
+    :return:
+    """
+    with open(src_path, 'rb') as src_fp, atomic_open(dst_path, buffer_size, mode) as dst_fp:
+        if not kernel_copy(src_fp.fileno(), dst_fp.fileno()):
+            shutil.copyfileobj(src_fp, dst_fp, buffer_size)
+
+
+def get_manifest_file(base_name: str) -> str:
+    """
+    Gets the name of the manifest file of an archive.
+
+    :param base_name: The full path of the archive file, minus the format extension.
+
+    :return: The full path of the manifest file.
+    """
+    return f'{base_name}.{MANIFEST_EXTENSION}'
+
+
+def get_member_archives(run_dir: str) -> dict:
+    """
+    Gets the completed member archives of the request group.
+
+    :param run_dir: The path of the directory to use for the staging operations.
+
+    :return: The member archive files keyed by the executor results directory they hold.
+    """
+    # init the return
+    ret_val: dict = {}
+
+    # member archives are named <run id>.<executor>.zip
+    for member_file in sorted(glob.glob(os.path.join(glob.escape(run_dir), MEMBER_ARCHIVE_DIR, '*.zip'))):
+        # get the run id and executor from the file name
+        run_id, executor = os.path.basename(member_file)[:-len('.zip')].rsplit('.', 1)
+
+        # save the member archive
+        ret_val[os.path.join(run_dir, run_id, executor)] = member_file
+
+    # return to the caller
+    return ret_val
+
+
+def read_member(archive_file: str, manifest_file: str, member_name: str) -> bytes:
+    """
+    Reads a single member from a zip archive using the archive manifest.
+
+    Only the member data is read from the archive, at the offset recorded in the manifest.
+
+    :param archive_file: The path of the zip archive.
+    :param manifest_file: The path of the archive manifest.
+    :param member_name: The name of the member in the archive.
+
+    :return: The uncompressed member data.
+    """
+    # load the manifest
+    with open(manifest_file, 'r', encoding='utf-8') as fp:
+        manifest: dict = json.load(fp)
+
+    # find the member
+    entry: dict = next((entry for entry in manifest['members'] if entry['path'] == member_name), None)
+
+    if entry is None:
+        raise KeyError(f'{member_name} was not found in {manifest_file}.')
+
+    # read the member data
+    with open(archive_file, 'rb') as fp:
+        fp.seek(entry['offset'])
+        data: bytes = fp.read(entry['compress_size'])
+
+    # inflate the raw deflate stream if needed
+    if entry['method'] == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+
+    # make sure the data is intact
+    if zlib.crc32(data) != entry['crc']:
+        raise zipfile.BadZipFile(f'Bad CRC for {member_name} in {archive_file}.')
+
+    # return to the caller
+    return data
+
+
+if __name__ == '__main__':
+    # extract a single member of an archive using its manifest.
+    #
+    # Args expected:
+    #    archive file - The path of the zip archive.
+    #    member name - The name of the member in the archive.
+    #    output file - The file to write the member to, or - for stdout.
+    if len(sys.argv) != 4:
+        sys.exit('Usage: python -m src.staging.archiver <archive file> <member name> <output file>')
+
+    # the manifest is named after the archive minus its extension
+    member_data: bytes = read_member(sys.argv[1], get_manifest_file(sys.argv[1][:-len('.zip')]), sys.argv[2])
+
+    # write out the member
+    if sys.argv[3] == '-':
+        sys.stdout.buffer.write(member_data)
+    else:
+        with open(sys.argv[3], 'wb') as member_fp:
+            member_fp.write(member_data)
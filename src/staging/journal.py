@@ -0,0 +1,189 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Final staging checkpoint journal.
+
+    The phases of final staging that a request group has completed are kept
+    in a small JSON file in the run directory so that a final staging step
+    that is interrupted (e.g. the pod is preempted) can be picked up from the
+    last completed phase rather than started over. The journal is only
+    written by the step that holds the request group lock.
+
+    Each run's published results are recorded in a marker file of its own,
+    so the final staging steps of a request group never write the same file.
+"""
+import json
+import os
+
+from src.common.logger import LoggingUtil
+from src.staging.archiver import atomic_open
+
+# the extension of the journal file, named .<request group>.<extension> in the run directory
+JOURNAL_EXTENSION: str = 'final-staging.journal'
+
+# the name of the directory (below the run directory) that holds a marker for each run whose results are published
+PUBLISHED_DIR: str = '.published'
+
+
+def get_journal_file(run_dir: str, request_group: str) -> str:
+    """
+    Gets the name of the final staging journal of a request group.
+
+    :param run_dir: The path of the directory to use for the staging operations.
+    :param request_group: The request group.
+
+    :return: The full path of the journal file.
+    """
+    return os.path.join(run_dir, f'.{request_group}.{JOURNAL_EXTENSION}')
+
+
+def get_published_file(run_dir: str, run_id: str) -> str:
+    """
+    Gets the name of the marker that records the published results of a run.
+
+    :param run_dir: The path of the directory to use for the staging operations.
+    :param run_id: The ID of the supervisor run request.
+
+    :return: The full path of the marker file.
+    """
+    return os.path.join(run_dir, PUBLISHED_DIR, f'{run_id}.json')
+
+
+def is_published(run_dir: str, run_id: str) -> bool:
+    """
+    Checks if the results of a run were published.
+
+    :param run_dir: The path of the directory to use for the staging operations.
+    :param run_id: The ID of the supervisor run request.
+
+    :return: True if the results were published.
+    """
+    return os.path.isfile(get_published_file(run_dir, run_id))
+
+
+def mark_published(run_dir: str, run_id: str, summary: dict):
+    """
+    Records that the results of a run were published. the marker is written in one step and synced.
+
+    :param run_dir: The path of the directory to use for the staging operations.
+    :param run_id: The ID of the supervisor run request.
+    :param summary: The published results summary.
+    :return:
+    """
+    # make sure the marker directory exists
+    os.makedirs(os.path.join(run_dir, PUBLISHED_DIR), exist_ok=True)
+
+    # save the marker
+    with atomic_open(get_published_file(run_dir, run_id)) as fp:
+        fp.write(json.dumps({'run_id': run_id, 'summary': summary}, separators=(',', ':')).encode('utf-8'))
+
+
+def clear_published(run_dir: str, run_id: str):
+    """
+    Removes the published results marker of a run, e.g. when the run is staged again.
+
+    :param run_dir: The path of the directory to use for the staging operations.
+    :param run_id: The ID of the supervisor run request.
+    :return:
+    """
+    try:
+        os.unlink(get_published_file(run_dir, run_id))
+    except FileNotFoundError:
+        pass
+
+
+class StagingJournal:
+    """
+    Class that records the completed final staging phases of a request group.
+
+    The file holds {"phases": {phase name: phase details}}.
+    """
+
+    def __init__(self, journal_file: str, _logger=None):
+        """
+        :param journal_file: The path of the journal file.
+        :param _logger: A logger to use.
+        """
+        # if a reference to a logger is passed in, use it
+        if _logger is not None:
+            # get a handle to a logger
+            self.logger = _logger
+        else:
+            # get the log level and directory from the environment.
+            log_level, log_path = LoggingUtil.prep_for_logging()
+
+            # create a logger
+            self.logger = LoggingUtil.init_logging("iRODS.Staging.Journal", level=log_level, line_format='medium', log_file_path=log_path)
+
+        # save the journal file path
+        self.journal_file: str = journal_file
+
+        # load the completed phases
+        self.phases: dict = self.load()
+
+    def load(self) -> dict:
+        """
+        Loads the completed phases. a missing or unreadable journal has none.
+
+        :return: The phase details keyed by phase name.
+        """
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as fp:
+                return json.load(fp)['phases']
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError):
+            self.logger.warning('WARNING: Unable to read the final staging journal %s.', self.journal_file)
+
+            return {}
+
+    def is_done(self, phase: str) -> bool:
+        """
+        Checks if a phase was completed.
+
+        :param phase: The phase name.
+        :return: True if the phase was completed.
+        """
+        return phase in self.phases
+
+    def get(self, phase: str) -> dict:
+        """
+        Gets the details recorded for a completed phase.
+
+        :param phase: The phase name.
+        :return: The phase details, empty if the phase was not completed.
+        """
+        return self.phases.get(phase, {})
+
+    def mark_done(self, phase: str, **details):
+        """
+        Records a completed phase. the journal is replaced in one step and synced so it survives the pod.
+
+        Only the holder of the request group lock may call this, the journal is not merged with concurrent changes.
+
+        :param phase: The phase name.
+        :param details: The details needed to pick up after the phase.
+        :return:
+        """
+        # record the phase
+        self.phases[phase] = details
+
+        # save the journal
+        with atomic_open(self.journal_file) as fp:
+            fp.write(json.dumps({'phases': self.phases}, separators=(',', ':')).encode('utf-8'))
+
+    def remove(self):
+        """
+        Removes the journal once all the phases are complete.
+
+        :return:
+        """
+        try:
+            os.unlink(self.journal_file)
+        except FileNotFoundError:
+            pass
+
+        # forget the phases
+        self.phases = {}
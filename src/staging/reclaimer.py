@@ -0,0 +1,196 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Background deletion of staging data.
+
+    Directories and files are removed from view with an atomic rename into a
+    tombstone directory and then deleted by a bounded pool of worker threads.
+"""
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from src.common.logger import LoggingUtil
+
+# the name of the directory (below the run directory) that holds the items waiting to be deleted
+TOMBSTONE_DIR: str = '.tombstones'
+
+
+class Reclaimer:
+    """
+    Class that buries items in a tombstone directory and deletes them in the background.
+
+    """
+
+    def __init__(self, workers: int = 4, _logger=None):
+        """
+        :param workers: The maximum number of concurrent deletions.
+        :param _logger: A logger to use.
+        """
+        # if a reference to a logger is passed in, use it
+        if _logger is not None:
+            # get a handle to a logger
+            self.logger = _logger
+        else:
+            # get the log level and directory from the environment.
+            log_level, log_path = LoggingUtil.prep_for_logging()
+
+            # create a logger
+            self.logger = LoggingUtil.init_logging("iRODS.Staging.Reclaimer", level=log_level, line_format='medium', log_file_path=log_path)
+
+        # create the deletion worker pool
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='reclaimer')
+
+        # the paths already queued for deletion and their futures
+        self.pending: dict = {}
+
+        # the buried directories whose entries are queued for deletion and the futures of those entries
+        self.tombstones: dict = {}
+
+        # protects the pending paths
+        self.lock = threading.Lock()
+
+    def bury(self, path: str, base_dir: str) -> bool:
+        """
+        Moves an item into the tombstone directory of base_dir.
+
+        If the item can not be renamed (e.g. it is on another file system) it is deleted inline.
+
+        :param path: The directory or file to remove.
+        :param base_dir: The directory that holds the tombstone directory. it must be on the same file system as the item.
+
+        :return: True if the item existed.
+        """
+        # nothing to do if it is not there
+        if not os.path.lexists(path):
+            return False
+
+        # get the tombstone directory
+        tombstone_dir: str = os.path.join(base_dir, TOMBSTONE_DIR)
+
+        try:
+            for attempt in range(2):
+                # make sure the tombstone directory exists
+                os.makedirs(tombstone_dir, exist_ok=True)
+
+                try:
+                    # move the item out of the way under a unique name
+                    os.rename(path, os.path.join(tombstone_dir, f'{os.path.basename(os.path.normpath(path))}.{uuid.uuid4().hex}'))
+
+                    break
+                except FileNotFoundError:
+                    # a concurrent wait() may have removed the emptied tombstone directory, try once more
+                    if attempt:
+                        raise
+        except OSError:
+            self.logger.warning('WARNING: Unable to bury %s, deleting it inline.', path)
+
+            # delete it now
+            self.delete(path)
+
+        # return to the caller
+        return True
+
+    @staticmethod
+    def delete(path: str):
+        """
+        Deletes a directory tree or a file.
+
+        :param path: The item to delete.
+        :return:
+        """
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def reclaim(self, base_dir: str):
+        """
+        Queues the contents of the tombstone directory of base_dir for deletion.
+
+        The top level entries of each tombstone are deleted in parallel. this returns without waiting.
+
+        :param base_dir: The directory that holds the tombstone directory.
+        :return:
+        """
+        # get the tombstone directory
+        tombstone_dir: str = os.path.join(base_dir, TOMBSTONE_DIR)
+
+        # get the buried files and the entries of the buried directories, splitting the directories up spreads the work
+        paths: list = []
+        tombstones: dict = {}
+
+        try:
+            with os.scandir(tombstone_dir) as tombstone_entries:
+                for tombstone in tombstone_entries:
+                    try:
+                        if tombstone.is_dir(follow_symlinks=False):
+                            with os.scandir(tombstone.path) as entries:
+                                tombstones[tombstone.path] = [entry.path for entry in entries]
+                        else:
+                            paths.append(tombstone.path)
+                    except OSError:
+                        # the tombstone was removed by a concurrent staging step
+                        continue
+        except OSError:
+            # there is no tombstone directory, or it was removed by a concurrent staging step
+            return
+
+        with self.lock:
+            # queue the items that are not already queued
+            for path in paths + [path for entries in tombstones.values() for path in entries]:
+                if path not in self.pending:
+                    self.pending[path] = self.executor.submit(self.delete, path)
+
+            # remember the buried directories so that they are removed once their entries are gone
+            for tombstone, entries in tombstones.items():
+                self.tombstones[tombstone] = [self.pending[path] for path in entries]
+
+        self.logger.debug('Reclaiming %s item(s) in %s.', len(paths) + sum(len(entries) for entries in tombstones.values()), tombstone_dir)
+
+    def wait(self, base_dir: str):
+        """
+        Waits for the queued deletions to finish and removes the emptied tombstones of base_dir.
+
+        Only the tombstones queued by reclaim() are removed. anything buried since then, e.g. by a concurrent staging step,
+        is left for the next reclaim().
+
+        :param base_dir: The directory that holds the tombstone directory.
+        :return:
+        """
+        # get the tombstone directory
+        tombstone_dir: str = os.path.join(base_dir, TOMBSTONE_DIR)
+
+        # get the queued deletions
+        with self.lock:
+            futures: list = list(self.pending.values())
+
+        # wait for them to finish
+        wait(futures)
+
+        with self.lock:
+            # forget the finished deletions
+            self.pending = {path: future for path, future in self.pending.items() if not future.done()}
+
+            # get the buried directories of base_dir whose entries are all deleted
+            emptied: list = [tombstone for tombstone, entry_futures in self.tombstones.items()
+                             if os.path.dirname(tombstone) == tombstone_dir and all(future.done() for future in entry_futures)]
+
+            # and forget them
+            for tombstone in emptied:
+                del self.tombstones[tombstone]
+
+        # remove the emptied tombstones and then the tombstone directory if nothing else was buried.
+        # these fail harmlessly if a concurrent staging step got there first or buried something new
+        for path in emptied + [tombstone_dir]:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
@@ -0,0 +1,431 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Test results functionality for the staging microservice.
+
+    JUnit XML test reports are parsed incrementally so that memory use
+    stays flat regardless of the size of the report files. The durations of
+    the requested tests are kept in a history file for balancing test shards.
+"""
+import glob
+import json
+import os
+import sys
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+
+from src.common.logger import LoggingUtil
+from src.common.staging_enums import StagingTestExecutor
+
+# the name of the directory (below an executor's results directory) that holds the reports carried forward from a previous attempt
+PREVIOUS_ATTEMPT_DIR: str = 'previous-attempt'
+
+
+class ResultsParser:
+    """
+    Class that summarizes the JUnit XML test reports of a run.
+
+    """
+
+    # the test case statuses, keyed by the JUnit child element that declares them
+    STATUS_ELEMENTS: dict = {'failure': 'failed', 'error': 'error', 'skipped': 'skipped'}
+
+    def __init__(self, _logger=None):
+        """
+        :param _logger: A logger to use.
+        """
+        # if a reference to a logger is passed in, use it
+        if _logger is not None:
+            # get a handle to a logger
+            self.logger = _logger
+        else:
+            # get the log level and directory from the environment.
+            log_level, log_path = LoggingUtil.prep_for_logging()
+
+            # create a logger
+            self.logger = LoggingUtil.init_logging("iRODS.Staging.ResultsParser", level=log_level, line_format='medium', log_file_path=log_path)
+
+    @staticmethod
+    def get_local_name(tag: str) -> str:
+        """
+        Removes any namespace from an element tag.
+
+        :param tag: The element tag.
+        :return: The tag name.
+        """
+        return tag.rsplit('}', 1)[-1]
+
+    @staticmethod
+    def get_case_name(elem) -> str:
+        """
+        Gets the fully qualified name of a test case element.
+
+        :param elem: The testcase element.
+        :return: The test case name, e.g. test_ils.Test_Ils.test_x
+        """
+        return f"{elem.get('classname')}.{elem.get('name')}" if elem.get('classname') else elem.get('name', '')
+
+    def parse_file(self, xml_file):
+        """
+        Streams the test cases out of a JUnit XML report.
+
+        Each test case element is discarded as soon as it is processed.
+
+        :param xml_file: The path of the report file, or a binary file object.
+
+        :return: A generator of (test name, status, duration) tuples.
+        """
+        # the stack of open elements, used to detach finished test cases from their parent
+        stack: list = []
+
+        for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+            # track the open elements
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            # remove the finished element from the stack
+            stack.pop()
+
+            # only test cases are of interest
+            if self.get_local_name(elem.tag) == 'testcase':
+                # get the fully qualified test name
+                name: str = self.get_case_name(elem)
+
+                # the status is declared by a child element, no child means it passed
+                status: str = next((self.STATUS_ELEMENTS[self.get_local_name(child.tag)] for child in elem
+                                    if self.get_local_name(child.tag) in self.STATUS_ELEMENTS), 'passed')
+
+                # get the test duration
+                try:
+                    duration: float = round(float(elem.get('time', 0)), 3)
+                except ValueError:
+                    duration: float = 0.0
+
+                yield name, status, duration
+
+                # release the element and detach it from its parent
+                elem.clear()
+
+                if stack:
+                    stack[-1].remove(elem)
+
+    @staticmethod
+    def new_summary() -> dict:
+        """
+        Creates an empty results summary.
+
+        :return: The summary counts.
+        """
+        return {'total': 0, 'passed': 0, 'failed': 0, 'error': 0, 'skipped': 0, 'time': 0.0}
+
+    def add_report(self, results: dict, executor: str, xml_file, report_name: str):
+        """
+        Adds the test cases of a JUnit XML report to a results summary.
+
+        :param results: The results summary to update.
+        :param executor: The test executor the report belongs to.
+        :param xml_file: The path of the report file, or a binary file object.
+        :param report_name: The name of the report for messages.
+        :return:
+        """
+        # get the executor results
+        executor_results: dict = results['executors'].setdefault(executor, {'summary': self.new_summary(), 'tests': []})
+
+        try:
+            for name, status, duration in self.parse_file(xml_file):
+                # save the test result
+                executor_results['tests'].append([name, status, duration])
+
+                # update the counts
+                for summary in (executor_results['summary'], results['summary']):
+                    summary['total'] += 1
+                    summary[status] += 1
+                    summary['time'] = round(summary['time'] + duration, 3)
+        except ET.ParseError:
+            self.logger.warning('WARNING: Unable to parse the test report %s.', report_name)
+
+    def get_run_results(self, run_dir: str) -> dict:
+        """
+        Summarizes the test reports of each executor of a run.
+
+        The reports are found in <run dir>/<executor>/.../test-reports/*.xml
+
+        :param run_dir: The path of the run directory.
+
+        :return: The results summary, with a [test name, status, duration] entry per test, or an empty dict if there are no reports.
+        """
+        # init the return
+        ret_val: dict = {'summary': self.new_summary(), 'executors': {}}
+
+        # add each report
+        for executor, report_name, fp in self.get_run_reports(run_dir):
+            self.add_report(ret_val, executor, fp, report_name)
+
+        # return to the caller
+        return ret_val if ret_val['executors'] else {}
+
+    @staticmethod
+    def get_run_reports(run_dir: str):
+        """
+        Gets the test reports of each executor of a run.
+
+        The reports are found in <run dir>/<executor>/.../test-reports/*.xml
+
+        :param run_dir: The path of the run directory.
+
+        :return: A generator of (executor, report path relative to the run directory, open binary file) tuples.
+        """
+        # for each executor
+        for executor in StagingTestExecutor.__members__:
+            # open each of its reports
+            for xml_file in sorted(glob.glob(os.path.join(glob.escape(run_dir), executor, '**', 'test-reports', '*.xml'), recursive=True)):
+                with open(xml_file, 'rb') as fp:
+                    yield executor, os.path.relpath(xml_file, run_dir).replace(os.sep, '/'), fp
+
+    def get_archive_results(self, archive_file: str, run_id: str) -> dict:
+        """
+        Summarizes the test reports of a run from a zip results archive.
+
+        The reports are members named <run id>/<executor>/.../test-reports/*.xml and are streamed out of the archive.
+
+        :param archive_file: The path of the zip archive.
+        :param run_id: The ID of the supervisor run request.
+
+        :return: The results summary, or an empty dict if there are no reports.
+        """
+        # init the return
+        ret_val: dict = {'summary': self.new_summary(), 'executors': {}}
+
+        # add each report of this run
+        for executor, report_name, fp in self.get_archive_reports(archive_file, run_id):
+            self.add_report(ret_val, executor, fp, report_name)
+
+        # return to the caller
+        return ret_val if ret_val['executors'] else {}
+
+    @staticmethod
+    def get_archive_reports(archive_file: str, run_id: str):
+        """
+        Gets the test reports of a run from a zip results archive.
+
+        The reports are members named <run id>/<executor>/.../test-reports/*.xml and are streamed out of the archive.
+
+        :param archive_file: The path of the zip archive.
+        :param run_id: The ID of the supervisor run request.
+
+        :return: A generator of (executor, report path relative to the run directory, open binary file) tuples.
+        """
+        with zipfile.ZipFile(archive_file) as zip_file:
+            for name in sorted(zip_file.namelist()):
+                # get the parts of the member name
+                parts: list = name.split('/')
+
+                # open the reports of this run
+                if len(parts) >= 4 and parts[0] == run_id and parts[1] in StagingTestExecutor.__members__ and parts[-2] == 'test-reports' and \
+                        name.endswith('.xml'):
+                    with zip_file.open(name) as fp:
+                        yield parts[1], '/'.join(parts[1:]), fp
+
+    def get_passed_report(self, xml_file, passed_tests: set, report_name: str) -> bytes:
+        """
+        Gets a copy of a JUnit XML report that only has the test cases of the tests that passed.
+
+        The test suite counts are updated to match the remaining test cases.
+
+        :param xml_file: The path of the report file, or a binary file object.
+        :param passed_tests: The names of the passed tests, e.g. test_ils
+        :param report_name: The name of the report for messages.
+
+        :return: The report, or None if it has no test cases of the passed tests.
+        """
+        try:
+            # reports are written per test class, so they are small enough to load
+            root = ET.parse(xml_file).getroot()
+        except ET.ParseError:
+            self.logger.warning('WARNING: Unable to parse the test report %s.', report_name)
+
+            return None
+
+        # init the number of test cases kept
+        kept: int = 0
+
+        # check the test cases of each element
+        for parent in list(root.iter()):
+            for case in [child for child in parent if self.get_local_name(child.tag) == 'testcase']:
+                # get the test case name
+                name: str = self.get_case_name(case)
+
+                # keep the test cases of the passed tests
+                if any(name == test or name.startswith(f'{test}.') for test in passed_tests):
+                    kept += 1
+                else:
+                    parent.remove(case)
+
+        # keep the suite counts in step with the remaining test cases, which all passed or were skipped
+        for suite in root.iter():
+            if self.get_local_name(suite.tag) in ('testsuite', 'testsuites'):
+                # get the remaining test cases
+                cases: list = [elem for elem in suite.iter() if self.get_local_name(elem.tag) == 'testcase']
+
+                # get their counts
+                counts: dict = {'tests': len(cases), 'failures': 0, 'errors': 0,
+                                'skipped': sum(1 for case in cases if any(self.get_local_name(child.tag) == 'skipped' for child in case))}
+
+                # update the counts the suite declares
+                for attribute, count in counts.items():
+                    if attribute in suite.attrib:
+                        suite.set(attribute, str(count))
+
+        # return to the caller
+        return ET.tostring(root, encoding='utf-8', xml_declaration=True) if kept else None
+
+    def write_previous_reports(self, run_dir: str, previous_reports: list):
+        """
+        Writes the reports carried forward from a previous attempt into a run directory, so that the published results
+        and the archive of a resumed run cover all of its tests.
+
+        :param run_dir: The path of the run directory.
+        :param previous_reports: The (executor, report path relative to the run directory, report data) tuples.
+        :return:
+        """
+        for executor, report_name, report in previous_reports:
+            # get the full path of the report below the executor's previous attempt directory
+            report_file: str = os.path.join(run_dir, executor, PREVIOUS_ATTEMPT_DIR, *report_name.split('/')[1:])
+
+            # create the directories
+            os.makedirs(os.path.dirname(report_file), exist_ok=True)
+
+            # the test pod writes its results into the executor directory
+            if sys.platform != 'win32':
+                os.chmod(os.path.join(run_dir, executor), 0o777)
+
+            # write out the report
+            with open(report_file, 'wb') as fp:
+                fp.write(report)
+
+        self.logger.debug('Carried %s report(s) forward into %s.', len(previous_reports), run_dir)
+
+    @staticmethod
+    def get_passed_tests(run_results: dict, tests: dict) -> dict:
+        """
+        Gets the requested tests that passed.
+
+        A requested test (e.g. test_ils) passed if it has test cases (e.g. test_ils.Test_Ils.test_x) and none failed.
+
+        :param run_results: The run results from get_run_results() or get_archive_results().
+        :param tests: The requested tests keyed by executor.
+
+        :return: The passed tests keyed by executor.
+        """
+        # init the return
+        ret_val: dict = {}
+
+        for executor, test_names in tests.items():
+            # get the test case results for the executor
+            cases: list = run_results.get('executors', {}).get(executor, {}).get('tests', [])
+
+            # init the passed tests
+            ret_val[executor] = set()
+
+            for test in test_names:
+                # get the statuses of the test cases for this test
+                statuses: list = [status for name, status, _ in cases if name == test or name.startswith(f'{test}.')]
+
+                # save the test if it ran and did not fail
+                if statuses and all(status in ('passed', 'skipped') for status in statuses):
+                    ret_val[executor].add(test)
+
+        # return to the caller
+        return ret_val
+
+
+class DurationHistory:
+    """
+    Class that keeps the historical duration of each requested test in a JSON file.
+
+    The file holds {executor: {test name: seconds}}.
+    """
+
+    def __init__(self, history_file: str, _logger=None):
+        """
+        :param history_file: The path of the history file.
+        :param _logger: A logger to use.
+        """
+        # if a reference to a logger is passed in, use it
+        if _logger is not None:
+            # get a handle to a logger
+            self.logger = _logger
+        else:
+            # get the log level and directory from the environment.
+            log_level, log_path = LoggingUtil.prep_for_logging()
+
+            # create a logger
+            self.logger = LoggingUtil.init_logging("iRODS.Staging.DurationHistory", level=log_level, line_format='medium', log_file_path=log_path)
+
+        # save the history file path
+        self.history_file: str = history_file
+
+        # load the durations
+        self.durations: dict = self.load()
+
+    def load(self) -> dict:
+        """
+        Loads the test durations. a missing or unreadable file is an empty history.
+
+        :return: The test durations.
+        """
+        try:
+            with open(self.history_file, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            self.logger.warning('WARNING: Unable to read the test duration history %s.', self.history_file)
+
+            return {}
+
+    def update(self, run_results: dict, tests: dict):
+        """
+        Updates the durations of the requested tests from a run's results.
+
+        A requested test (e.g. test_ils) covers every test case named after it (e.g. test_ils.Test_Ils.test_x).
+
+        :param run_results: The run results from ResultsParser.get_run_results().
+        :param tests: The requested tests keyed by executor.
+        :return:
+        """
+        for executor, test_names in tests.items():
+            # skip executors with no results
+            if executor not in run_results.get('executors', {}):
+                continue
+
+            # get the history for the executor
+            executor_durations: dict = self.durations.setdefault(executor, {})
+
+            for test in test_names:
+                # get the durations of the test cases for this test
+                case_durations: list = [duration for name, _, duration in run_results['executors'][executor]['tests']
+                                        if name == test or name.startswith(f'{test}.')]
+
+                # save the total
+                if case_durations:
+                    executor_durations[test] = round(sum(case_durations), 3)
+
+    def save(self):
+        """
+        Saves the test durations, replacing the file in one step so readers never see a partial file.
+
+        :return:
+        """
+        # write to a temporary file next to the history file
+        fd, tmp_file = tempfile.mkstemp(prefix='.durations-', dir=os.path.dirname(os.path.abspath(self.history_file)))
+
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            json.dump(self.durations, fp, separators=(',', ':'))
+
+        # put it in place
+        os.replace(tmp_file, self.history_file)
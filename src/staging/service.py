@@ -0,0 +1,186 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Long-running service mode for the staging microservice.
+
+    Staging requests are accepted over HTTP and handed to a single Staging
+    object, so that the pooled DB connections stay warm between requests.
+    Each request is processed in its own thread and may stage several runs.
+"""
+import json
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.common.staging_enums import StagingType, WorkflowTypeName, ReturnCodes
+
+
+def parse_stage_request(request: dict) -> tuple:
+    """
+    Validates a staging request.
+
+    :param request: The request with run_id (or a run_ids list), run_dir, step_type and optionally workflow_type.
+
+    :return: The validation return code (0, -2 for invalid types or -3 for missing params) and the run_batch() arguments.
+    """
+    # get the params
+    run_ids: list = request.get('run_ids') or [request.get('run_id')]
+    run_dir: str = str(request.get('run_dir') or '')
+    step_type: str = str(request.get('step_type') or '')
+    workflow_type: str = str(request.get('workflow_type', WorkflowTypeName.CORE.value) or '')
+
+    # missing 1 or more params
+    if not isinstance(run_ids, list) or not all(run_ids) or run_dir == '' or step_type == '' or workflow_type == '':
+        return -3, None
+
+    try:
+        # check to make sure we got a legit staging and workflow types
+        return 0, ([str(run_id) for run_id in run_ids], run_dir, StagingType(step_type), WorkflowTypeName(workflow_type))
+    except ValueError:
+        # invalid input types
+        return -2, None
+
+
+class StagingRequestHandler(BaseHTTPRequestHandler):
+    """
+    Class that handles the staging service HTTP requests.
+
+    POST /stage runs a staging step and GET /health reports that the service is up.
+    """
+
+    def send_json(self, status: int, body: dict):
+        """
+        Sends a JSON response.
+
+        :param status: The HTTP status code.
+        :param body: The response body.
+        :return:
+        """
+        # encode the body
+        data: bytes = json.dumps(body).encode('utf-8')
+
+        # send the response
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Handles the health check.
+
+        :return:
+        """
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'version': self.server.staging.app_version})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Handles a staging request. the response holds the staging return code.
+
+        :return:
+        """
+        if self.path != '/stage':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        try:
+            # get the request
+            request: dict = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            self.send_json(400, {'error': 'invalid JSON'})
+            return
+
+        # validate it
+        ret_val, run_args = parse_stage_request(request) if isinstance(request, dict) else (-3, None)
+
+        # init the return codes of the runs
+        results: dict = {}
+
+        # should we continue?
+        if ret_val == 0:
+            # get the number of runs to stage at once, if given
+            workers: int = int(request['workers']) if str(request.get('workers', '')).isdigit() else None
+
+            # do the staging
+            results = {run_id: int(code) for run_id, code in self.server.staging.run_batch(*run_args, workers=workers).items()}
+
+            # get the overall return code
+            ret_val = get_batch_ret_val(results)
+
+        self.send_json(200 if run_args else 400, {'ret_val': ret_val, 'results': results})
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Sends the request log to the staging logger.
+
+        :return:
+        """
+        self.server.staging.logger.debug('Service request from %s: %s', self.address_string(), format % args)
+
+
+class StagingService(ThreadingHTTPServer):
+    """
+    Class that serves staging requests over HTTP.
+
+    """
+
+    # do not wait for the request threads on shutdown
+    daemon_threads: bool = True
+
+    def __init__(self, staging, host: str = '127.0.0.1', port: int = 8080):
+        """
+        :param staging: The Staging object that runs the requests.
+        :param host: The address to listen on.
+        :param port: The port to listen on, 0 picks a free port.
+        """
+        # save the staging object for the request handlers
+        self.staging = staging
+
+        # init the base class
+        super().__init__((host, port), StagingRequestHandler)
+
+
+def get_batch_ret_val(results: dict) -> int:
+    """
+    Gets the overall return code of a batch of runs.
+
+    A run whose request group was archived by a peer succeeded.
+
+    :param results: The return code of each run keyed by run id.
+    :return: The first failure in run order, or success.
+    """
+    return next((int(code) for code in results.values() if code not in (ReturnCodes.EXIT_CODE_SUCCESS, ReturnCodes.HANDLED_BY_PEER)),
+                int(ReturnCodes.EXIT_CODE_SUCCESS))
+
+
+def post_stage_request(service_url: str, request: dict) -> dict:
+    """
+    Sends a staging request to a staging service.
+
+    :param service_url: The base URL of the service, e.g. http://127.0.0.1:8080
+    :param request: The request with run_id (or a run_ids list), run_dir, step_type and workflow_type.
+
+    :return: The response, with the overall return code in ret_val and the return code of each run in results.
+    """
+    # create the request
+    http_request = urllib.request.Request(f"{service_url.rstrip('/')}/stage", data=json.dumps(request).encode('utf-8'),
+                                          headers={'Content-Type': 'application/json'}, method='POST')
+
+    try:
+        # send it. staging steps can take a while, so there is no timeout
+        with urllib.request.urlopen(http_request) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        # validation errors carry a return code
+        try:
+            return json.load(e)
+        except ValueError:
+            return {'ret_val': int(ReturnCodes.EXCEPTION_RUN_PROCESSING), 'results': {}}
+    except (OSError, ValueError):
+        return {'ret_val': int(ReturnCodes.EXCEPTION_RUN_PROCESSING), 'results': {}}
@@ -0,0 +1,84 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Staging settings.
+
+    The environment settings of the staging steps, grouped by the part of
+    staging that uses them.
+"""
+import os
+
+from src.common.staging_enums import ArchiveFormat
+from src.staging.archiver import ArchiveBuilder, STORED_EXTENSIONS, WRITE_BUFFER_SIZE
+
+
+class ArchiveSettings:
+    """
+    Class that holds the test results archive settings.
+
+    """
+
+    def __init__(self):
+        # get the number of archive compression workers (0 uses all cores)
+        self.workers: int = int(os.getenv('ARCHIVE_WORKERS', '0'))
+
+        # get the test results archive format
+        self.archive_format: ArchiveFormat = ArchiveFormat(os.getenv('ARCHIVE_FORMAT', ArchiveFormat.ZIP_DEFLATE.value))
+
+        # get the archive compression level, empty uses the default for the format
+        self.level: int = int(os.getenv('ARCHIVE_LEVEL')) if os.getenv('ARCHIVE_LEVEL') else None
+
+        # get the comma separated extensions of files that are already compressed
+        stored_extensions: str = os.getenv('ARCHIVE_STORED_EXTENSIONS', ','.join(STORED_EXTENSIONS))
+        self.stored_extensions: tuple = tuple(ext.strip() for ext in stored_extensions.split(',') if ext.strip())
+
+        # get the size of the write buffer for archive files and their copies
+        self.write_buffer: int = int(os.getenv('ARCHIVE_WRITE_BUFFER', str(WRITE_BUFFER_SIZE)))
+
+        # get the flag to archive each executor's results as soon as its run finishes (zip formats only)
+        self.incremental: bool = os.getenv('INCREMENTAL_ARCHIVE', 'false').lower() == 'true'
+
+    def create_builder(self, _logger=None) -> ArchiveBuilder:
+        """
+        Creates an archive builder with these settings.
+
+        :param _logger: A logger to use.
+        :return: The archive builder.
+        """
+        return ArchiveBuilder(self.workers, self.level, self.archive_format, self.stored_extensions, self.write_buffer, _logger=_logger)
+
+
+class TestSettings:
+    """
+    Class that holds the test script settings.
+
+    """
+
+    # this is not a test class
+    __test__: bool = False
+
+    def __init__(self):
+        # get the default number of test shards per executor, a request can override it with "test-shards"
+        self.shards: int = int(os.getenv('TEST_SHARDS', '1'))
+
+        # get the path of the file that keeps the historical test durations, empty to disable
+        self.history_file: str = os.getenv('TEST_DURATION_HISTORY', '')
+
+
+class FinalStagingSettings:
+    """
+    Class that holds the settings for waiting on the other runs of a request group.
+
+    """
+
+    def __init__(self):
+        # get the number of seconds final staging waits for the other runs of the request group to complete, 0 to not wait
+        self.wait_timeout: float = float(os.getenv('FINAL_STAGING_WAIT_TIMEOUT', '0'))
+
+        # get the DB notification channel that announces run status changes, the payload is the request group
+        self.notify_channel: str = os.getenv('FINAL_STAGING_NOTIFY_CHANNEL', 'irods_sv_run_status')
+
+        # get the number of seconds between run status checks while waiting, in case a notification is missed
+        self.recheck_interval: float = float(os.getenv('FINAL_STAGING_RECHECK_INTERVAL', '60'))
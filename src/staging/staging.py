@@ -6,14 +6,32 @@
     Main entry point for the staging microservice application
 """
 import os
+import copy
+import functools
 import json
-import shutil
 import sys
 import glob
+import heapq
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from src.common.logger import LoggingUtil
 from src.common.pg_impl import PGImplementation
 from src.common.staging_enums import StagingType, StagingTestExecutor, WorkflowTypeName, ReturnCodes
+from src.staging.results import ResultsParser, DurationHistory
+from src.staging.reclaimer import Reclaimer, TOMBSTONE_DIR
+from src.staging.journal import StagingJournal, JOURNAL_EXTENSION, PUBLISHED_DIR, get_journal_file, is_published, mark_published, clear_published
+from src.staging.archiver import ArchiveBuilder, ARCHIVE_EXTENSIONS, ZIP_FORMATS, MEMBER_ARCHIVE_DIR, MANIFEST_EXTENSION, get_manifest_file, \
+    get_member_archives, copy_file
+from src.staging.settings import ArchiveSettings, TestSettings, FinalStagingSettings
+
+# the name of the directory (below the run directory) that holds the cached run definitions
+RUN_DEF_CACHE_DIR: str = '.run-defs'
+
+# the version of the run definition cache file layout
+RUN_DEF_CACHE_VERSION: int = 1
 
 
 class Staging:
@@ -39,13 +57,29 @@ class Staging:
         # note the extra comma makes this single item a singleton tuple
         db_names: tuple = ('irods-sv',)
 
-        # create a DB connection object
-        self.db_info: PGImplementation = PGImplementation(db_names, _logger=self.logger)
+        # create a DB connection object. it connects on the first query so that steps with nothing to do never wait on the DB
+        self.db_info: PGImplementation = PGImplementation(db_names, _logger=self.logger, _lazy_connect=True)
 
         # get the default iRODS package directory
         self.default_pkg_dir = os.getenv('DEFAULT_PKG_DIR', '')
 
-    def run(self, run_id: str, run_dir: str, step_type: StagingType, workflow_type: WorkflowTypeName = WorkflowTypeName.CORE) -> ReturnCodes:
+        # get the test results archive settings
+        self.archive_settings: ArchiveSettings = ArchiveSettings()
+
+        # get the test script settings
+        self.test_settings: TestSettings = TestSettings()
+
+        # get the settings for waiting on the other runs of a request group
+        self.final_staging_settings: FinalStagingSettings = FinalStagingSettings()
+
+        # get the default number of runs staged at once in a batch
+        self.batch_workers: int = int(os.getenv('STAGING_WORKERS', '4'))
+
+        # create the background deleter of old run data
+        self.reclaimer: Reclaimer = Reclaimer(int(os.getenv('RECLAIM_WORKERS', '4')), _logger=self.logger)
+
+    def run(self, run_id: str, run_dir: str, step_type: StagingType, workflow_type: WorkflowTypeName = WorkflowTypeName.CORE,
+            archive_group: bool = True) -> ReturnCodes:
         """
         Performs the requested type of staging operation.
 
@@ -55,12 +89,16 @@ class Staging:
         :param run_dir: The base path of the directory to use for the staging operations.
         :param step_type: The type of staging step, either 'initial' or 'final'.
         :param workflow_type: The type of workflow.
+        :param archive_group: In final staging, archive the request group if it is complete.
 
         :return:
         """
         # init the return value
         ret_val: ReturnCodes = ReturnCodes.EXIT_CODE_SUCCESS
 
+        # start deleting data left behind by earlier staging steps while this one runs
+        self.reclaimer.reclaim(run_dir)
+
         # is this an initial stage step?
         if step_type == StagingType.INITIAL_STAGING:
             # make the call to perform the op
@@ -68,7 +106,64 @@ class Staging:
         # else this a final stage step
         elif step_type == StagingType.FINAL_STAGING:
             # make the call to perform the op
-            ret_val = self.final_staging(run_id, run_dir, step_type)
+            ret_val = self.final_staging(run_id, run_dir, step_type, archive_group)
+
+        # delete what this step removed and wait for the deletions to finish before exiting
+        self.reclaimer.reclaim(run_dir)
+        self.reclaimer.wait(run_dir)
+
+        # return to the caller
+        return ret_val
+
+    def run_batch(self, run_ids: list, run_dir: str, step_type: StagingType, workflow_type: WorkflowTypeName = WorkflowTypeName.CORE,
+                  workers: int = None) -> dict:
+        """
+        Performs the requested type of staging operation for several runs at once.
+
+        In final staging the results of all the runs are published first, then each request group in the batch is archived once,
+        by one of its runs whose directory is still there.
+
+        :param run_ids: The ids of the runs.
+        :param run_dir: The base path of the directory to use for the staging operations.
+        :param step_type: The type of staging step, either 'initial' or 'final'.
+        :param workflow_type: The type of workflow.
+        :param workers: The maximum number of runs staged at once, None for the default.
+
+        :return: The return code of each run keyed by run id.
+        """
+        # remove any duplicate runs
+        run_ids = list(dict.fromkeys(run_ids))
+
+        # stage the runs, in final staging without archiving
+        with ThreadPoolExecutor(max_workers=max(1, workers or self.batch_workers), thread_name_prefix='staging') as executor:
+            futures: dict = {run_id: executor.submit(self.run, run_id, run_dir, step_type, workflow_type, False) for run_id in run_ids}
+
+        # get the return codes
+        ret_val: dict = {run_id: future.result() for run_id, future in futures.items()}
+
+        # in final staging, get the runs of each request group that were staged
+        if step_type == StagingType.FINAL_STAGING:
+            request_groups: dict = {}
+
+            for run_id in run_ids:
+                # the run definition is cached by final staging
+                run_data: json = self.load_run_def(run_dir, run_id) if ret_val[run_id] == ReturnCodes.EXIT_CODE_SUCCESS else None
+
+                if run_data is not None:
+                    request_groups.setdefault(run_data['request_group'], []).append(run_id)
+
+            # archive each request group once. a group's runs share the run directory, so this is done one group at a time
+            for request_group, group_run_ids in request_groups.items():
+                # use a run whose directory is still there
+                for run_id in group_run_ids:
+                    if os.path.isdir(os.path.join(run_dir, run_id)):
+                        self.logger.info('Archiving request group %s with run_id: %s', request_group, run_id)
+
+                        ret_val[run_id] = self.run(run_id, run_dir, step_type, workflow_type)
+
+                        break
+                else:
+                    self.logger.warning('WARNING: No run directory is left to archive request group %s', request_group)
 
         # return to the caller
         return ret_val
@@ -99,11 +194,29 @@ class Staging:
 
             # did getting the data to go ok
             if run_data != -1:
-                # remove the run directory, ignore errors as it may not exist
-                shutil.rmtree(new_run_dir, ignore_errors=True)
+                # cache the run definition for the later staging steps of the run
+                self.save_run_def(run_dir, run_id, run_data)
+
+                # init the reports carried forward from a previous attempt
+                previous_reports: list = []
+
+                # in resume mode the results of the previous attempt are needed before they are removed
+                if run_data['request_data'].get('resume', False) and 'tests' in run_data['request_data']:
+                    # remove the tests that already passed from the request and keep their reports
+                    run_data, previous_reports = self.get_resume_run_data(run_id, run_dir, run_data)
+
+                # move the run directory out of the way for background deletion, it may not exist
+                self.reclaimer.bury(new_run_dir, run_dir)
+
+                # remove the final staging journals of previous runs so that they are not picked up again
+                for file in glob.glob(os.path.join(run_dir, f'.*.{JOURNAL_EXTENSION}')):
+                    self.reclaimer.bury(file, run_dir)
 
-                # remove zip files from previous runs
-                for file in glob.glob(os.path.join(run_dir, '*.zip')):
+                # the results of this run are to be published again
+                clear_published(run_dir, run_id)
+
+                # remove member archives of this run from a previous attempt
+                for file in glob.glob(os.path.join(run_dir, MEMBER_ARCHIVE_DIR, f'{glob.escape(run_id)}.*.zip')):
                     # remove the file
                     os.unlink(file)
 
@@ -117,6 +230,9 @@ class Staging:
                 if sys.platform != 'win32':
                     os.chmod(new_run_dir, 0o777)
 
+                # put the reports of the tests that are not run again into the new run directory
+                ResultsParser(_logger=self.logger).write_previous_reports(new_run_dir, previous_reports)
+
                 # if there are tests requested, create the files
                 if 'tests' in run_data['request_data']:
                     # create the test file(s)
@@ -137,9 +253,70 @@ class Staging:
         # return the result to the caller
         return ret_val
 
+    def get_resume_run_data(self, run_id: str, run_dir: str, run_data: json) -> tuple:
+        """
+        Removes the tests that passed in a previous attempt of the run from the run data.
+
+        The previous results are read from the run directory or, if that is gone, from the group's results archive.
+        only zip archives can be read. the archive is kept until final staging archives the group again, so every run of the group can use it.
+
+        :param run_id: The ID of the supervisor run request.
+        :param run_dir: The base path of the directory to use for the staging operations.
+        :param run_data: The run data information from the supervisor.
+
+        :return: The run data with only the tests that failed or never ran, and the (executor, report path, report data)
+        tuples of the reports of the passed tests.
+        """
+        # create the results parser
+        results_parser = ResultsParser(_logger=self.logger)
+
+        # get the results left in the run directory
+        previous_results: dict = results_parser.get_run_results(os.path.join(run_dir, run_id))
+
+        # get the reports of the previous attempt
+        get_reports = functools.partial(results_parser.get_run_reports, os.path.join(run_dir, run_id))
+
+        # get the group's results archive
+        archive_file: str = os.path.join(run_dir, f"{run_data['request_group']}.test-results."
+                                                  f"{ARCHIVE_EXTENSIONS[self.archive_settings.archive_format]}")
+
+        # fall back to the results in the archive
+        if not previous_results and self.archive_settings.archive_format in ZIP_FORMATS and os.path.isfile(archive_file):
+            previous_results = results_parser.get_archive_results(archive_file, run_id)
+
+            get_reports = functools.partial(results_parser.get_archive_reports, archive_file, run_id)
+
+        # get the tests that passed
+        passed_tests: dict = results_parser.get_passed_tests(previous_results, run_data['request_data']['tests'])
+
+        # init the reports of the passed tests
+        previous_reports: list = []
+
+        # keep the test cases of the passed tests from each report
+        for executor, report_name, fp in get_reports():
+            report: bytes = results_parser.get_passed_report(fp, passed_tests.get(executor, set()), report_name)
+
+            if report:
+                previous_reports.append((executor, report_name, report))
+
+        # make a copy of the run data to update
+        ret_val: json = copy.deepcopy(run_data)
+
+        # keep the tests that did not pass
+        for executor, tests in ret_val['request_data']['tests'].items():
+            ret_val['request_data']['tests'][executor] = [test for test in tests if test not in passed_tests[executor]]
+
+            self.logger.info('Resuming run_id: %s, executor: %s, skipping %s passed test(s), %s test(s) remaining.', run_id, executor,
+                             len(tests) - len(ret_val['request_data']['tests'][executor]), len(ret_val['request_data']['tests'][executor]))
+
+        # return to the caller
+        return ret_val, previous_reports
+
     def create_test_files(self, run_dir: str, run_data: json, workflow_type: WorkflowTypeName) -> ReturnCodes:
         """
-        Creates the files that contain the requested test executor and tests.
+        Creates the files that contain the requested tests for each test executor in the request.
+
+        The files for the executors are created concurrently.
 
         :param run_dir: The path of the directory to use for the staging operations.
         :param run_data: The run data information from the supervisor.
@@ -150,80 +327,97 @@ class Staging:
         # init the return
         ret_val: ReturnCodes = ReturnCodes.EXIT_CODE_SUCCESS
 
-        # init the filename storage
-        out_file_name: str = 'empty'
-
         self.logger.info('Creating test files. run_dir: %s, workflow type: %s', run_dir, workflow_type)
 
         try:
-            # get the test executor run location
-            executor = next(iter(run_data['request_data']['tests']))
+            # get the test executors in the request
+            executors: list = list(run_data['request_data']['tests'])
 
-            # is this a legit executor?
-            if executor in StagingTestExecutor.__members__:
-                # get the list of tests for this executor
-                tests = run_data['request_data']['tests'][executor]
+            # create the files for all the executors at once
+            with ThreadPoolExecutor(max_workers=max(1, len(executors))) as executor_pool:
+                results: list = list(executor_pool.map(lambda executor: self.create_executor_test_files(run_dir, executor, run_data, workflow_type),
+                                                       executors))
 
-                # check the list of tests
-                if len(tests) > 0:
-                    # generate the output path/file name
-                    out_file_name = os.path.join(run_dir, f'{executor}_test_list.sh')
-
-                    # write out the data
-                    with open(out_file_name, 'w', encoding='utf-8') as fp:
-                        self.logger.debug('Writing to %s', out_file_name)
-
-                        # write out the preamble and get into the test results directory
-                        fp.write('#/bin/bash\ncd /var/lib/irods;\n')
-
-                        # init the base command line.
-                        base_cmd_line: str = ''
-
-                        # init the topology test type
-                        topology_test_type: str = ''
+            # any failure fails the request
+            ret_val = next((result for result in results if result != ReturnCodes.EXIT_CODE_SUCCESS), ReturnCodes.EXIT_CODE_SUCCESS)
 
-                        # get the data path
-                        data_path: str = os.path.join(run_dir, executor)
+        except Exception:
+            # declare ready
+            self.logger.exception('Exception: Error creating the test files in %s.', run_dir)
 
-                        # get the command line
-                        if workflow_type == WorkflowTypeName.CORE:
-                            # assign the base command line
-                            base_cmd_line = 'python3 scripts/run_tests.py --xml_output'
-                        elif workflow_type == WorkflowTypeName.TOPOLOGY:
-                            # assign the base command line
-                            base_cmd_line = 'python3 scripts/run_tests.py --xml_output --hostnames TEST_HOST_NAMES --topology '
+            # set the return
+            ret_val = ReturnCodes.ERROR_TEST_FILE
 
-                            # if this is a provider instance type
-                            if executor in [StagingTestExecutor.PROVIDER.name, StagingTestExecutor.PROVIDERSECONDARY.name]:
-                                # get the topology test type
-                                topology_test_type = 'icat'
-                            # else it is a consumer instance type
-                            elif executor in [StagingTestExecutor.CONSUMER.name, StagingTestExecutor.CONSUMERSECONDARY.name,
-                                              StagingTestExecutor.CONSUMERTERTIARY.name]:
-                                # get the topology test type
-                                topology_test_type = 'resource'
+        # return to the caller
+        return ret_val
 
-                        # write out each test listed in the request
-                        for test in tests:
-                            # create the test entry with some extra info
-                            fp.write(f'echo "Running {test}"; {base_cmd_line}{topology_test_type} --run_s {test};\n')
+    def create_executor_test_files(self, run_dir: str, executor: str, run_data: json, workflow_type: WorkflowTypeName) -> ReturnCodes:
+        """
+        Creates the files that contain the requested tests for a test executor.
 
-                        # create the results directory in the k8s file store
-                        fp.write(f'echo "Creating the run results dir {data_path}..."; mkdir {data_path};\n')
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param executor: The test executor name.
+        :param run_data: The run data information from the supervisor.
+        :param workflow_type: The type of workflow.
 
-                        # save the log directory for extended forensics
-                        fp.write(f'echo "Copying /var/lib/irods/log dir into {data_path}..."; cp -R /var/lib/irods/log {data_path};\n')
+        :return:
+        """
+        # init the return
+        ret_val: ReturnCodes = ReturnCodes.EXIT_CODE_SUCCESS
 
-                        # save the log directory for extended forensics
-                        fp.write(f'echo "Copying /var/lib/irods/test-reports dir into {data_path}..."; cp -R /var/lib/irods/test-reports'
-                                 f' {data_path};\n')
+        # init the filename storage
+        out_file_name: str = 'empty'
 
-                        # this directory may or may not exist
-                        fp.write(f'echo "Copying /var/log/irods dir into {data_path}..."; cp -R /var/log/irods {data_path};\n')
+        try:
+            # is this a legit executor?
+            if executor in StagingTestExecutor.__members__:
+                # get the list of tests for this executor
+                tests = run_data['request_data']['tests'][executor]
 
-                    # make sure the file has the correct permissions
-                    if sys.platform != 'win32':
-                        os.chmod(out_file_name, 0o777)
+                # check the list of tests
+                if len(tests) > 0:
+                    # init the base command line.
+                    base_cmd_line: str = ''
+
+                    # init the topology test type
+                    topology_test_type: str = ''
+
+                    # get the command line
+                    if workflow_type == WorkflowTypeName.CORE:
+                        # assign the base command line
+                        base_cmd_line = 'python3 scripts/run_tests.py --xml_output'
+                    elif workflow_type == WorkflowTypeName.TOPOLOGY:
+                        # assign the base command line
+                        base_cmd_line = 'python3 scripts/run_tests.py --xml_output --hostnames TEST_HOST_NAMES --topology '
+
+                        # if this is a provider instance type
+                        if executor in [StagingTestExecutor.PROVIDER.name, StagingTestExecutor.PROVIDERSECONDARY.name]:
+                            # get the topology test type
+                            topology_test_type = 'icat'
+                        # else it is a consumer instance type
+                        elif executor in [StagingTestExecutor.CONSUMER.name, StagingTestExecutor.CONSUMERSECONDARY.name,
+                                          StagingTestExecutor.CONSUMERTERTIARY.name]:
+                            # get the topology test type
+                            topology_test_type = 'resource'
+
+                    # get the number of shards requested
+                    shard_count: int = int(run_data['request_data'].get('test-shards', self.test_settings.shards))
+
+                    # split the tests into shards that should take about the same time to run
+                    shards: list = self.shard_tests(tests, shard_count, self.get_test_durations(executor))
+
+                    # write out a file for each shard
+                    for index, shard_tests in enumerate(shards, start=1):
+                        # a single shard keeps the original file name and results directory
+                        if len(shards) == 1:
+                            out_file_name = os.path.join(run_dir, f'{executor}_test_list.sh')
+                            data_path: str = os.path.join(run_dir, executor)
+                        else:
+                            out_file_name = os.path.join(run_dir, f'{executor}_test_list_{index}.sh')
+                            data_path: str = os.path.join(run_dir, executor, f'shard-{index}')
+
+                        # write out the file
+                        self.write_test_file(out_file_name, shard_tests, f'{base_cmd_line}{topology_test_type}', data_path)
 
                 else:
                     self.logger.debug('WARNING: An executor was specified with no tests. executor name %s, run_dir: %s, workflow type: %s', executor,
@@ -242,13 +436,119 @@ class Staging:
         # return to the caller
         return ret_val
 
-    def final_staging(self, run_id: str, run_dir: str, staging_type: StagingType) -> ReturnCodes:
+    def write_test_file(self, out_file_name: str, tests: list, cmd_line: str, data_path: str):
+        """
+        Writes out a script that runs a list of tests and saves the results.
+
+        Each test gets its own test command, run_tests.py only takes one dotted name after --run_s.
+
+        :param out_file_name: The path of the script file.
+        :param tests: The tests to run.
+        :param cmd_line: The test command line.
+        :param data_path: The results directory in the k8s file store.
+        :return:
+        """
+        # create a temporary file next to the target so a partial file is never seen
+        fd, tmp_file_name = tempfile.mkstemp(prefix=f'.{os.path.basename(out_file_name)}.', dir=os.path.dirname(out_file_name))
+
+        try:
+            # write out the data
+            with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                self.logger.debug('Writing to %s', out_file_name)
+
+                # write out the preamble and get into the test results directory
+                fp.write('#/bin/bash\ncd /var/lib/irods;\n')
+
+                # write out each test listed in the request
+                for test in tests:
+                    # create the test entry with some extra info
+                    fp.write(f'echo "Running {test}"; {cmd_line} --run_s {test};\n')
+
+                # create the results directory in the k8s file store
+                fp.write(f'echo "Creating the run results dir {data_path}..."; mkdir -p {data_path};\n')
+
+                # save the log directory for extended forensics
+                fp.write(f'echo "Copying /var/lib/irods/log dir into {data_path}..."; cp -R /var/lib/irods/log {data_path};\n')
+
+                # save the log directory for extended forensics
+                fp.write(f'echo "Copying /var/lib/irods/test-reports dir into {data_path}..."; cp -R /var/lib/irods/test-reports {data_path};\n')
+
+                # this directory may or may not exist
+                fp.write(f'echo "Copying /var/log/irods dir into {data_path}..."; cp -R /var/log/irods {data_path};\n')
+
+            # make sure the file has the correct permissions
+            if sys.platform != 'win32':
+                os.chmod(tmp_file_name, 0o777)
+        except Exception:
+            # do not leave a partial file behind
+            os.unlink(tmp_file_name)
+
+            raise
+
+        # put the file in place
+        os.replace(tmp_file_name, out_file_name)
+
+    def get_test_durations(self, executor: str) -> dict:
+        """
+        Gets the historical test durations for an executor.
+
+        :param executor: The test executor name.
+
+        :return: The test durations in seconds keyed by test name. empty if there is no history.
+        """
+        # no history file means no durations
+        if not self.test_settings.history_file:
+            return {}
+
+        # return to the caller
+        return DurationHistory(self.test_settings.history_file, _logger=self.logger).durations.get(executor, {})
+
+    @staticmethod
+    def shard_tests(tests: list, shard_count: int, durations: dict) -> list:
+        """
+        Splits a list of tests into shards balanced by duration, using the longest processing time first rule.
+
+        Tests with no history are given the average known duration. with no history at all the
+        shards are balanced by test count. each shard keeps the requested test order.
+
+        :param tests: The list of tests.
+        :param shard_count: The number of shards requested.
+        :param durations: The historical test durations keyed by test name.
+
+        :return: A list of test lists.
+        """
+        # get the duration for tests with no history
+        known: list = [durations[test] for test in tests if test in durations]
+        default_duration: float = sum(known) / len(known) if known else 1.0
+
+        # there can not be more shards than tests
+        shard_count = max(1, min(shard_count, len(tests)))
+
+        # a heap of the shards by (total duration, test count, shard index)
+        heap: list = [(0.0, 0, index) for index in range(shard_count)]
+
+        # the positions of the tests in each shard
+        assigned: list = [[] for _ in range(shard_count)]
+
+        # put the longest test remaining into the least loaded shard
+        for position, test in sorted(enumerate(tests), key=lambda item: -durations.get(item[1], default_duration)):
+            load, count, index = heapq.heappop(heap)
+
+            assigned[index].append(position)
+
+            heapq.heappush(heap, (load + durations.get(test, default_duration), count + 1, index))
+
+        # return to the caller
+        return [[tests[position] for position in sorted(positions)] for positions in assigned]
+
+    def final_staging(self, run_id: str, run_dir: str, staging_type: StagingType, archive_group: bool = True) -> ReturnCodes:
         """
         Performs the final staging
 
         :param run_id: The ID of the supervisor run request.
         :param run_dir: The path of the directory to use for the staging operations.
         :param staging_type: The type of staging step, either 'initial' or 'final'
+        :param archive_group: Archive the request group if it is complete.
         :return:
         """
         # init the return code
@@ -264,41 +564,53 @@ class Staging:
             if os.path.isdir(new_run_dir):
                 self.logger.info('Run dir exists. run_dir: %s', new_run_dir)
 
-                # try to make the call for run data records
-                run_data: json = self.db_info.get_run_def(run_id)
+                # get the run definition cached by initial staging
+                run_data: json = self.load_run_def(run_dir, run_id)
 
-                # did getting the data to go ok
-                if run_data != ReturnCodes.DB_ERROR:
-                    # make the call to get the run status
-                    run_status = self.db_info.get_run_status(run_data['request_group'])
-
-                    # if all runs are complete
-                    if run_status['Testing Jobs']['Total'] == run_status['Testing Jobs']['Complete']:
-                        # get the full path to the test results archive file
-                        k8s_archive_file: str = os.path.join(run_dir, f"{run_data['request_group']}.test-results")
-
-                        self.logger.info('Creating k8s archive: %s.zip', k8s_archive_file)
-
-                        # compress the directory into the k8s data directory
-                        shutil.make_archive(k8s_archive_file, 'zip', run_dir)
-
-                        # if the package directory is defined
-                        if run_data['request_data']['package-dir']:
-                            # get the full path to the test results archive file
-                            nfs_archive_file: str = os.path.join(run_data['request_data']['package-dir'], f"{run_data['request_group']}.test-results")
-
-                            self.logger.info('Creating nfs archive: %s.zip', k8s_archive_file)
-
-                            # compress the directory into the package directory
-                            shutil.make_archive(nfs_archive_file, 'zip', run_dir)
+                # make the call to get the run status, or if the cache is not usable,
+                # the run data records and the run status of the request group in one round trip
+                if run_data is not None:
+                    run_complete: bool = self.db_info.is_run_group_complete(run_data['request_group'])
+                else:
+                    run_data, run_complete = self.db_info.get_run_def_and_complete(run_id)
 
-                            # adjust the file properties of the archive to 775
-                            os.chmod(f'{nfs_archive_file}.zip', 0o775)
+                    # cache it for the rest of the step
+                    if run_data != ReturnCodes.DB_ERROR:
+                        self.save_run_def(run_dir, run_id, run_data)
 
-                        # remove all directories from the run (leaving the archive file)
-                        [shutil.rmtree(data_dir, ignore_errors=True) for data_dir in glob.glob(f'{run_dir}/**/')]
+                # did getting the data to go ok. on a DB error the supervisor reschedules the step
+                if ReturnCodes.DB_ERROR in (run_data, run_complete):
+                    ret_val = ReturnCodes.DB_ERROR
+                else:
+                    # the results of an interrupted final staging step may already be published
+                    if is_published(run_dir, run_id):
+                        self.logger.info('Test results already published: run_id: %s', run_id)
+                    else:
+                        # publish the test results of this run
+                        ret_val = self.publish_run_results(run_id, run_dir, run_data)
+
+                    # create the archive builder
+                    archive_builder = self.archive_settings.create_builder(_logger=self.logger)
+
+                    # get the final staging journal of the request group
+                    journal = StagingJournal(get_journal_file(run_dir, run_data['request_group']), _logger=self.logger)
+
+                    # in incremental mode this run's results are compressed now, off the end of the group's critical path.
+                    # once the group archive is built, an interrupted step has nothing left to compress
+                    if self.archive_settings.incremental and archive_builder.is_zip() and not journal.is_done('archive_k8s'):
+                        archive_builder.build_run_members(run_dir, run_id)
+
+                    # in wait mode, wait for the other runs of the request group to complete
+                    if archive_group and self.final_staging_settings.wait_timeout > 0 and not run_complete:
+                        run_complete = self.wait_for_run_group(run_data['request_group'])
+
+                    # if all runs are complete, the results are published and this run archives the request group.
+                    # the run directories are removed with the archive, so the group waits for a rescheduled step that publishes
+                    if archive_group and run_complete and ret_val == ReturnCodes.EXIT_CODE_SUCCESS:
+                        ret_val = self.archive_run_group_once(run_dir, new_run_dir, run_data, archive_builder)
             else:
-                ret_val = ReturnCodes.ERROR_NO_RUN_DIR
+                # an interrupted final staging step may have archived the request group and removed this run's directory already
+                ret_val = self.resume_run_group(run_dir, new_run_dir)
         except Exception:
             # declare ready
             self.logger.exception('Exception: The iRODS K8s "%s" final staging request for run directory %s failed.', staging_type, new_run_dir)
@@ -310,3 +622,361 @@ class Staging:
 
         # return the result to the caller
         return ret_val
+
+    def publish_run_results(self, run_id: str, run_dir: str, run_data: json) -> ReturnCodes:
+        """
+        Publishes the test results of a run so the outcome is known without opening the archive.
+
+        :param run_id: The ID of the supervisor run request.
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param run_data: The run definition.
+
+        :return: The return code, DB_ERROR if the results could not be published.
+        """
+        # summarize the test reports of this run
+        run_results: dict = ResultsParser(_logger=self.logger).get_run_results(os.path.join(run_dir, run_id))
+
+        # nothing to publish
+        if not run_results:
+            return ReturnCodes.EXIT_CODE_SUCCESS
+
+        self.logger.info('Publishing test results: run_id: %s, summary: %s', run_id, run_results['summary'])
+
+        # publish them
+        if self.db_info.update_run_results(run_id, run_results) == ReturnCodes.DB_ERROR:
+            self.logger.error('Error publishing the test results: run_id: %s', run_id)
+
+            return ReturnCodes.DB_ERROR
+
+        # record it
+        mark_published(run_dir, run_id, run_results['summary'])
+
+        # save the test durations for balancing future test shards
+        if self.test_settings.history_file:
+            # load the history
+            history = DurationHistory(self.test_settings.history_file, _logger=self.logger)
+
+            # update and save it
+            history.update(run_results, run_data['request_data'].get('tests', {}))
+            history.save()
+
+        # return to the caller
+        return ReturnCodes.EXIT_CODE_SUCCESS
+
+    def archive_run_group_once(self, run_dir: str, new_run_dir: str, run_data: json, archive_builder: ArchiveBuilder) -> ReturnCodes:
+        """
+        Archives a complete request group unless a peer final staging step is doing or has done it.
+
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param new_run_dir: The path of the run's directory.
+        :param run_data: The run definition.
+        :param archive_builder: The archive builder.
+
+        :return: The return code.
+        """
+        # init the return code
+        ret_val: ReturnCodes = ReturnCodes.EXIT_CODE_SUCCESS
+
+        # take the request group lock so that only one final staging step archives the group
+        lock_conn = self.db_info.try_lock_run_group(run_data['request_group'])
+
+        # was the lock available?
+        if lock_conn is None:
+            ret_val = ReturnCodes.DB_ERROR
+        elif lock_conn is False:
+            self.logger.info('Request group %s is being archived by a peer.', run_data['request_group'])
+
+            ret_val = ReturnCodes.HANDLED_BY_PEER
+        else:
+            try:
+                # a peer that held the lock earlier archives the group and removes this run's directory, unless it was interrupted
+                if os.path.isdir(new_run_dir) or StagingJournal(get_journal_file(run_dir, run_data['request_group']),
+                                                                _logger=self.logger).is_done('archive_k8s'):
+                    ret_val = self.archive_run_group(run_dir, run_data, archive_builder)
+                else:
+                    self.logger.info('Request group %s was archived by a peer.', run_data['request_group'])
+
+                    ret_val = ReturnCodes.HANDLED_BY_PEER
+            finally:
+                # release the lock
+                self.db_info.unlock_run_group(run_data['request_group'], lock_conn)
+
+        # return to the caller
+        return ret_val
+
+    def resume_run_group(self, run_dir: str, new_run_dir: str) -> ReturnCodes:
+        """
+        Picks up the archiving of a request group whose final staging step was interrupted after the k8s archive was built.
+
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param new_run_dir: The path of the run's directory.
+
+        :return: The return code, ERROR_NO_RUN_DIR if there is nothing to pick up.
+        """
+        # init the return code
+        ret_val: ReturnCodes = ReturnCodes.ERROR_NO_RUN_DIR
+
+        # for each journal in the run directory
+        for journal_file in glob.glob(os.path.join(glob.escape(run_dir), f'.*.{JOURNAL_EXTENSION}')):
+            # get the archived request group, if any
+            details: dict = StagingJournal(journal_file, _logger=self.logger).get('archive_k8s')
+
+            if details:
+                self.logger.info('Resuming final staging of request group %s.', details['request_group'])
+
+                # the journal has what is needed from the run definition
+                run_data: dict = {'request_group': details['request_group'], 'request_data': {'package-dir': details['package_dir']}}
+
+                # create the archive builder
+                archive_builder = self.archive_settings.create_builder(_logger=self.logger)
+
+                # finish archiving the group
+                ret_val = self.archive_run_group_once(run_dir, new_run_dir, run_data, archive_builder)
+
+        # return to the caller
+        return ret_val
+
+    def archive_run_group(self, run_dir: str, run_data: json, archive_builder: ArchiveBuilder) -> ReturnCodes:
+        """
+        Archives the results of a complete request group, copies the archive to the package directory and removes the run data.
+
+        The completed phases are recorded in the request group's journal so that an interrupted step is picked up where it left off.
+        The run directories are removed with the archive, so the results of the runs that were not published yet are published first.
+
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param run_data: The run definition.
+        :param archive_builder: The archive builder.
+
+        :return: The return code, DB_ERROR if the results of a run could not be published.
+        """
+        # get the final staging journal of the request group
+        journal = StagingJournal(get_journal_file(run_dir, run_data['request_group']), _logger=self.logger)
+
+        # the results of the runs are all published before the archive is built
+        if not journal.is_done('archive_k8s'):
+            # for each run directory
+            for peer_run_dir in glob.glob(f'{glob.escape(run_dir)}/**/'):
+                # get the run id from the directory name
+                peer_run_id: str = os.path.basename(os.path.dirname(peer_run_dir))
+
+                # skip the runs that published their results
+                if is_published(run_dir, peer_run_id):
+                    continue
+
+                self.logger.info('Publishing the test results of peer run_id: %s', peer_run_id)
+
+                # get the cached run definition, or if it is not usable the one in the DB
+                peer_run_data: json = self.load_run_def(run_dir, peer_run_id) or self.db_info.get_run_def(peer_run_id)
+
+                # the run directories are kept until the results are published, the supervisor reschedules the step
+                if peer_run_data == ReturnCodes.DB_ERROR or self.publish_run_results(peer_run_id, run_dir, peer_run_data) != \
+                        ReturnCodes.EXIT_CODE_SUCCESS:
+                    return ReturnCodes.DB_ERROR
+
+        # get the full path to the test results archive file, minus the format extension
+        k8s_archive_base: str = os.path.join(run_dir, f"{run_data['request_group']}.test-results")
+
+        # get the member archive and run definition cache directories
+        member_archive_dir: str = os.path.join(run_dir, MEMBER_ARCHIVE_DIR)
+        run_def_cache_dir: str = os.path.join(run_dir, RUN_DEF_CACHE_DIR)
+
+        # the archive is only built again if it was not completed
+        if journal.is_done('archive_k8s') and os.path.isfile(journal.get('archive_k8s')['archive_file']):
+            k8s_archive_file: str = journal.get('archive_k8s')['archive_file']
+
+            self.logger.info('Using the existing k8s archive: %s', k8s_archive_file)
+        else:
+            # the archive and manifest files of previous runs were kept for the resumed runs of the group, which have all been staged now.
+            # move them out of the way for background deletion
+            for extension in set(ARCHIVE_EXTENSIONS.values()) | {MANIFEST_EXTENSION}:
+                for file in glob.glob(os.path.join(glob.escape(run_dir), f'*.{extension}')):
+                    self.reclaimer.bury(file, run_dir)
+
+            self.logger.info('Creating k8s archive: %s', k8s_archive_base)
+
+            # compress the directory into the k8s data directory, merging in any member archives.
+            # this is the only compression pass
+            k8s_archive_file: str = archive_builder.build(run_dir, k8s_archive_base,
+                                                          (member_archive_dir, run_def_cache_dir, os.path.join(run_dir, TOMBSTONE_DIR),
+                                                           os.path.join(run_dir, PUBLISHED_DIR), journal.journal_file),
+                                                          get_member_archives(run_dir))
+
+            # record the archive and what is needed to finish without the run definition
+            journal.mark_done('archive_k8s', archive_file=k8s_archive_file, request_group=run_data['request_group'],
+                              package_dir=run_data['request_data']['package-dir'])
+
+        # the member archives and cached run definitions are no longer needed
+        self.reclaimer.bury(member_archive_dir, run_dir)
+        self.reclaimer.bury(run_def_cache_dir, run_dir)
+
+        # if the package directory is defined and the archive was not copied there yet
+        if run_data['request_data']['package-dir'] and not journal.is_done('archive_nfs'):
+            # get the full path to the test results archive file
+            nfs_archive_file: str = os.path.join(run_data['request_data']['package-dir'], os.path.basename(k8s_archive_file))
+
+            self.logger.info('Copying k8s archive to nfs: %s', nfs_archive_file)
+
+            # copy the already compressed archive into the package directory with the file properties set to 775.
+            # it is written under a temporary name and renamed into place once complete
+            copy_file(k8s_archive_file, nfs_archive_file, self.archive_settings.write_buffer, 0o775)
+
+            # copy the archive manifest along with it
+            if os.path.isfile(get_manifest_file(k8s_archive_base)):
+                # get the full path to the manifest file
+                nfs_manifest_file: str = os.path.join(run_data['request_data']['package-dir'],
+                                                      os.path.basename(get_manifest_file(k8s_archive_base)))
+
+                # copy the manifest with the same file properties
+                copy_file(get_manifest_file(k8s_archive_base), nfs_manifest_file, self.archive_settings.write_buffer, 0o775)
+
+            # record the copy
+            journal.mark_done('archive_nfs', archive_file=nfs_archive_file)
+
+        # remove all directories from the run (leaving the archive file). they are deleted in the background
+        for data_dir in glob.glob(f'{run_dir}/**/'):
+            self.reclaimer.bury(data_dir, run_dir)
+
+        # record the removal
+        journal.mark_done('delete_dirs')
+
+        # the published results markers are no longer needed (hidden directories are not matched above)
+        if os.path.isdir(os.path.join(run_dir, PUBLISHED_DIR)):
+            self.reclaimer.bury(os.path.join(run_dir, PUBLISHED_DIR), run_dir)
+
+        # with all the phases complete, remove the journal
+        journal.remove()
+
+        # return to the caller
+        return ReturnCodes.EXIT_CODE_SUCCESS
+
+    def wait_for_run_group(self, request_group: str) -> bool:
+        """
+        Waits for all the testing jobs of a request group to complete, or the wait timeout.
+
+        The run status is checked again each time a notification for the request group (or with no payload) arrives on the
+        notification channel, and at the recheck interval in case one is missed. if the channel can not be listened to,
+        the run status is polled at the recheck interval.
+
+        :param request_group: The request group of the run.
+
+        :return: True if the request group completed.
+        """
+        self.logger.info('Waiting up to %s seconds for request group %s to complete.', self.final_staging_settings.wait_timeout, request_group)
+
+        # get the time to give up
+        deadline: float = time.monotonic() + self.final_staging_settings.wait_timeout
+
+        # init the completion flag and the listening connection
+        run_complete: bool = False
+        conn = None
+
+        # get the time of the next status check without a notification
+        next_check: float = time.monotonic() + self.final_staging_settings.recheck_interval
+
+        try:
+            # until the request group is complete or the time is up
+            while not run_complete and time.monotonic() < deadline:
+                if conn is None:
+                    # subscribe to the status notifications. the status is checked again after this so an earlier notification is not missed.
+                    # connecting does not wait past the deadline
+                    conn = self.db_info.listen('irods-sv', self.final_staging_settings.notify_channel, deadline - time.monotonic())
+
+                    # if that is not possible, fall back to polling
+                    if conn is None:
+                        time.sleep(max(0.0, min(self.final_staging_settings.recheck_interval, deadline - time.monotonic())))
+                else:
+                    # wait for a notification until the next recheck
+                    payloads: list = self.db_info.wait_notify(conn, min(next_check, deadline) - time.monotonic())
+
+                    # a broken connection is opened again
+                    if payloads is None:
+                        self.db_info.discard_conn(conn)
+
+                        conn = None
+                    # notifications for other request groups are ignored until the next recheck
+                    elif payloads and request_group not in payloads and '' not in payloads and time.monotonic() < next_check:
+                        continue
+
+                # check the run status, an error is retried at the next check
+                run_complete = self.db_info.is_run_group_complete(request_group) is True
+
+                # get the time of the next status check
+                next_check = time.monotonic() + self.final_staging_settings.recheck_interval
+        finally:
+            # stop listening
+            if conn is not None:
+                self.db_info.discard_conn(conn)
+
+        self.logger.info('Request group %s complete: %s', request_group, run_complete)
+
+        # return to the caller
+        return run_complete
+
+    @staticmethod
+    def get_run_def_hash(run_data: json) -> str:
+        """
+        Gets a hash of the canonical JSON of a run definition.
+
+        :param run_data: The run definition.
+        :return: The SHA-256 hex digest.
+        """
+        return hashlib.sha256(json.dumps(run_data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def save_run_def(self, run_dir: str, run_id: str, run_data: json):
+        """
+        Caches a run definition in <run dir>/.run-defs/<run id>.json.
+
+        The file is replaced in one step so readers never see a partial file.
+
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param run_id: The ID of the supervisor run request.
+        :param run_data: The run definition from the DB.
+        :return:
+        """
+        # get the cache directory
+        cache_dir: str = os.path.join(run_dir, RUN_DEF_CACHE_DIR)
+
+        try:
+            # make sure the directory exists
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # write to a temporary file in the cache directory
+            fd, tmp_file = tempfile.mkstemp(prefix=f'.{run_id}-', dir=cache_dir)
+
+            with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                json.dump({'version': RUN_DEF_CACHE_VERSION, 'run_id': run_id, 'hash': self.get_run_def_hash(run_data), 'run_def': run_data}, fp)
+
+            # put it in place
+            os.replace(tmp_file, os.path.join(cache_dir, f'{run_id}.json'))
+        except OSError:
+            # the DB is still there to fall back on
+            self.logger.warning('WARNING: Unable to cache the run definition for run_id: %s', run_id)
+
+    def load_run_def(self, run_dir: str, run_id: str) -> json:
+        """
+        Loads a run definition cached by initial staging.
+
+        :param run_dir: The path of the directory to use for the staging operations.
+        :param run_id: The ID of the supervisor run request.
+
+        :return: The run definition, or None if the cache is missing or stale.
+        """
+        try:
+            with open(os.path.join(run_dir, RUN_DEF_CACHE_DIR, f'{run_id}.json'), 'r', encoding='utf-8') as fp:
+                cache: dict = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self.logger.warning('WARNING: Unable to read the cached run definition for run_id: %s', run_id)
+
+            return None
+
+        # the cache must be from this version, for this run and intact
+        if cache.get('version') != RUN_DEF_CACHE_VERSION or cache.get('run_id') != run_id or \
+                cache.get('hash') != self.get_run_def_hash(cache.get('run_def')):
+            self.logger.warning('WARNING: The cached run definition for run_id: %s is stale.', run_id)
+
+            return None
+
+        # return to the caller
+        return cache['run_def']
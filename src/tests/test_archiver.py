@@ -0,0 +1,292 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Archive builder tests.
+
+"""
+import errno
+import json
+import os
+import shutil
+import tarfile
+import zipfile
+
+import pytest
+
+from src.staging.archiver import ArchiveBuilder, get_manifest_file, read_member, zstandard, atomic_open, copy_file, PARTIAL_SUFFIX, \
+    SCRATCH_PREFIX
+from src.common.staging_enums import ArchiveFormat
+
+
+def create_test_tree(base_dir: str):
+    """
+    creates a small directory tree of compressible and incompressible files
+
+    :param base_dir: The directory to populate.
+    :return:
+    """
+    # create a test executor directory with a nested and an empty directory
+    os.makedirs(os.path.join(base_dir, '1', 'PROVIDER', 'test-reports'))
+    os.makedirs(os.path.join(base_dir, '1', 'PROVIDER', 'log'))
+
+    # create some files
+    for index in range(10):
+        with open(os.path.join(base_dir, '1', 'PROVIDER', 'test-reports', f'TEST-{index}.xml'), 'w', encoding='utf-8') as fp:
+            fp.write(f'<testsuite name="test_{index}"/>\n' * 100 * index)
+
+        with open(os.path.join(base_dir, '1', f'random-{index}.bin'), 'wb') as fp:
+            fp.write(os.urandom(1000 * index))
+
+
+def test_parallel_archive(tmp_path):
+    """
+    tests that the parallel archive builder creates a valid zip file
+
+    :return:
+    """
+    # create the source data
+    create_test_tree(str(tmp_path))
+
+    # build the archive inside the directory being archived using several workers
+    archive_file: str = ArchiveBuilder(workers=4).build(str(tmp_path), os.path.join(tmp_path, 'group.test-results'))
+
+    with zipfile.ZipFile(archive_file) as zip_file:
+        # the archive must pass the CRC checks and not include itself
+        assert zip_file.testzip() is None and 'group.test-results.zip' not in zip_file.namelist()
+
+        # the empty directory must be present
+        assert '1/PROVIDER/log/' in zip_file.namelist()
+
+        # each file must match the original
+        for name in zip_file.namelist():
+            if not name.endswith('/'):
+                with open(os.path.join(tmp_path, name), 'rb') as fp:
+                    assert zip_file.read(name) == fp.read()
+
+
+def test_archive_workers_not_forked(tmp_path, monkeypatch):
+    """
+    tests that the compression workers are not forked from the staging process, which may be running other threads
+
+    :return:
+    """
+    # create the source data
+    create_test_tree(str(tmp_path))
+
+    # the staging process must not fork
+    def no_fork():
+        raise AssertionError('forked the staging process')
+
+    monkeypatch.setattr(os, 'fork', no_fork)
+
+    # build the archive using several workers
+    archive_file: str = ArchiveBuilder(workers=2).build(str(tmp_path), os.path.join(tmp_path, 'group.test-results'))
+
+    with zipfile.ZipFile(archive_file) as zip_file:
+        assert zip_file.testzip() is None
+
+
+def test_archive_formats(tmp_path):
+    """
+    tests the archive formats and the policy of storing already compressed files
+
+    :return:
+    """
+    # create the source data, including a file that is already compressed
+    create_test_tree(str(tmp_path))
+
+    with open(os.path.join(tmp_path, '1', 'rodsLog.1.gz'), 'wb') as fp:
+        fp.write(b'compressible data ' * 1000)
+
+    # build a deflated zip. the gz file must be stored, the rest compressed
+    archive_file: str = ArchiveBuilder(workers=1).build(str(tmp_path), os.path.join(tmp_path, 'deflate'))
+
+    with zipfile.ZipFile(archive_file) as zip_file:
+        assert zip_file.getinfo('1/rodsLog.1.gz').compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo('1/PROVIDER/test-reports/TEST-9.xml').compress_type == zipfile.ZIP_DEFLATED
+
+    # build an uncompressed zip
+    archive_file = ArchiveBuilder(workers=2, archive_format=ArchiveFormat.ZIP_STORE).build(str(tmp_path), os.path.join(tmp_path, 'store'))
+
+    with zipfile.ZipFile(archive_file) as zip_file:
+        assert zip_file.testzip() is None and zip_file.getinfo('1/PROVIDER/test-reports/TEST-9.xml').compress_type == zipfile.ZIP_STORED
+
+    # build a gzip compressed tar
+    archive_file = ArchiveBuilder(archive_format=ArchiveFormat.TAR_GZ, level=1).build(str(tmp_path), os.path.join(tmp_path, 'gzip'))
+
+    with tarfile.open(archive_file) as tar_file:
+        assert archive_file.endswith('.tar.gz') and '1/PROVIDER/test-reports/TEST-9.xml' in tar_file.getnames()
+
+
+@pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")
+def test_zstd_archive(tmp_path):
+    """
+    tests the zstandard compressed tar archive format
+
+    :return:
+    """
+    # create the source data
+    create_test_tree(str(tmp_path))
+
+    # build the archive
+    archive_file: str = ArchiveBuilder(workers=2, archive_format=ArchiveFormat.TAR_ZST).build(str(tmp_path), os.path.join(tmp_path, 'zstd'))
+
+    # read it back
+    with open(archive_file, 'rb') as fp, zstandard.ZstdDecompressor().stream_reader(fp) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar_file:
+            assert '1/PROVIDER/test-reports/TEST-9.xml' in [member.name for member in tar_file]
+
+
+def test_member_archive_merge(tmp_path):
+    """
+    tests merging a per-executor member archive into the final archive without recompression
+
+    :return:
+    """
+    # create the source data
+    create_test_tree(str(tmp_path))
+
+    # create the builder
+    archive_builder = ArchiveBuilder(workers=2)
+
+    # compress the executor directory into a member archive outside the source tree
+    os.makedirs(os.path.join(tmp_path, 'members'))
+
+    member_file: str = archive_builder.build_member(str(tmp_path), os.path.join(tmp_path, '1', 'PROVIDER'),
+                                                    os.path.join(tmp_path, 'members', '1.PROVIDER'))
+
+    # build the final archive, reusing the member archive for the executor directory
+    archive_file: str = archive_builder.build(str(tmp_path), os.path.join(tmp_path, 'merged'), (os.path.join(tmp_path, 'members'),),
+                                              {os.path.join(tmp_path, '1', 'PROVIDER'): member_file})
+
+    # build the same archive in one pass for comparison
+    full_file: str = archive_builder.build(str(tmp_path), os.path.join(tmp_path, 'full'), (os.path.join(tmp_path, 'members'), archive_file,
+                                                                                          get_manifest_file(os.path.join(tmp_path, 'merged'))))
+
+    with zipfile.ZipFile(archive_file) as merged_zip, zipfile.ZipFile(full_file) as full_zip:
+        # the merged archive must be valid and hold the same members as the single pass archive
+        assert merged_zip.testzip() is None and sorted(merged_zip.namelist()) == sorted(full_zip.namelist())
+
+        # and the same data
+        for name in full_zip.namelist():
+            assert merged_zip.read(name) == full_zip.read(name)
+
+
+def test_archive_manifest(tmp_path):
+    """
+    tests reading single members using the archive manifest
+
+    :return:
+    """
+    # create the source data
+    create_test_tree(str(tmp_path))
+
+    # build the archive
+    archive_file: str = ArchiveBuilder(workers=2).build(str(tmp_path), os.path.join(tmp_path, 'group.test-results'))
+
+    # load the manifest
+    with open(get_manifest_file(os.path.join(tmp_path, 'group.test-results')), 'r', encoding='utf-8') as fp:
+        manifest: dict = json.load(fp)
+
+    # the executor is recorded for executor results
+    assert {entry['path']: entry['executor'] for entry in manifest['members']}['1/PROVIDER/test-reports/TEST-5.xml'] == 'PROVIDER'
+
+    # each member read by offset must match the original file
+    for entry in manifest['members']:
+        with open(os.path.join(tmp_path, entry['path']), 'rb') as fp:
+            assert read_member(archive_file, get_manifest_file(os.path.join(tmp_path, 'group.test-results')), entry['path']) == fp.read()
+
+    # a rebuild does not pack the previous archive or manifest
+    ArchiveBuilder(workers=2).build(str(tmp_path), os.path.join(tmp_path, 'group.test-results'))
+
+    with zipfile.ZipFile(archive_file) as zip_file:
+        assert not [name for name in zip_file.namelist() if name.startswith('group.test-results')]
+
+
+def test_atomic_writes(tmp_path):
+    """
+    tests that archive files only appear once they are complete
+
+    :return:
+    """
+    # create the source data
+    create_test_tree(str(tmp_path))
+
+    # a failed write leaves nothing behind
+    with pytest.raises(RuntimeError):
+        with atomic_open(os.path.join(tmp_path, 'failed.zip')) as fp:
+            fp.write(b'partial data')
+
+            raise RuntimeError('interrupted')
+
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.zip') or name.endswith(PARTIAL_SUFFIX)]
+
+    # a leftover partial file is never archived
+    with open(os.path.join(tmp_path, f'.old.zip.1234{PARTIAL_SUFFIX}'), 'wb') as fp:
+        fp.write(b'partial data')
+
+    # neither is the scratch directory of an interrupted build
+    os.makedirs(os.path.join(tmp_path, f'{SCRATCH_PREFIX}1234'))
+
+    with open(os.path.join(tmp_path, f'{SCRATCH_PREFIX}1234', 'tmp1234'), 'wb') as fp:
+        fp.write(b'compressed data')
+
+    # build the archive with a small write buffer and copy it with the requested permissions
+    archive_file: str = ArchiveBuilder(workers=2, write_buffer=1024).build(str(tmp_path), os.path.join(tmp_path, 'group.test-results'))
+
+    os.makedirs(os.path.join(tmp_path, 'nfs'))
+
+    copy_file(archive_file, os.path.join(tmp_path, 'nfs', 'group.test-results.zip'), 4096, 0o775)
+
+    with zipfile.ZipFile(os.path.join(tmp_path, 'nfs', 'group.test-results.zip')) as zip_file:
+        assert zip_file.testzip() is None and not [name for name in zip_file.namelist() if name.endswith(PARTIAL_SUFFIX) or SCRATCH_PREFIX in name]
+
+    # the copy is complete and has the requested permissions
+    assert os.listdir(os.path.join(tmp_path, 'nfs')) == ['group.test-results.zip'] and \
+        os.stat(os.path.join(tmp_path, 'nfs', 'group.test-results.zip')).st_mode & 0o777 == 0o775
+
+
+def test_kernel_copy(tmp_path, monkeypatch):
+    """
+    tests that copies are made by the kernel, and through a buffer where the kernel can not copy between the files
+
+    :return:
+    """
+    # create a file to copy
+    data: bytes = os.urandom(3 * 1024 * 1024)
+
+    with open(os.path.join(tmp_path, 'group.test-results.zip'), 'wb') as fp:
+        fp.write(data)
+
+    # keep the buffered copy
+    buffered_copy = shutil.copyfileobj
+
+    # the data must not pass through a buffer
+    def no_buffered_copy(*_args):
+        raise AssertionError('copied through a buffer')
+
+    monkeypatch.setattr(shutil, 'copyfileobj', no_buffered_copy)
+
+    copy_file(os.path.join(tmp_path, 'group.test-results.zip'), os.path.join(tmp_path, 'kernel.zip'), 4096, 0o775)
+
+    with open(os.path.join(tmp_path, 'kernel.zip'), 'rb') as fp:
+        assert fp.read() == data
+
+    # the kernel can not copy between the files
+    def not_supported(*_args):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    for name in ('copy_file_range', 'sendfile'):
+        monkeypatch.setattr(os, name, not_supported, raising=False)
+
+    monkeypatch.setattr(shutil, 'copyfileobj', buffered_copy)
+
+    copy_file(os.path.join(tmp_path, 'group.test-results.zip'), os.path.join(tmp_path, 'buffered.zip'), 4096, 0o775)
+
+    with open(os.path.join(tmp_path, 'buffered.zip'), 'rb') as fp:
+        assert fp.read() == data
+
+    # only the copies are left
+    assert sorted(os.listdir(tmp_path)) == ['buffered.zip', 'group.test-results.zip', 'kernel.zip']
@@ -0,0 +1,345 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    DB connection handling tests.
+
+"""
+import select
+import socket
+import time
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+from src.common.pg_utils_multi import PGUtilsMultiConnect
+from src.common.staging_enums import ReturnCodes
+
+
+def test_connect_gives_up(monkeypatch):
+    """
+    tests that unreachable DBs are given up on after the maximum wait
+
+    :return:
+    """
+    # get a local port that nothing is listening on
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port: int = sock.getsockname()[1]
+
+    # point two DB connections at it
+    for db_name in ('TEST', 'TEST_RESULTS'):
+        for name, value in {'HOST': '127.0.0.1', 'PORT': str(port), 'DATABASE': 'test', 'USERNAME': 'test', 'PASSWORD': 'test'}.items():
+            monkeypatch.setenv(f'{db_name}_DB_{name}', value)
+
+    # use short retry settings
+    for name, value in {'DB_CONNECT_TIMEOUT': '1', 'DB_RETRY_BASE': '0.1', 'DB_RETRY_CAP': '0.5', 'DB_MAX_WAIT': '2'}.items():
+        monkeypatch.setenv(name, value)
+
+    # get the start time
+    start: float = time.monotonic()
+
+    # the process must exit with a DB error
+    with pytest.raises(SystemExit) as exc_info:
+        PGUtilsMultiConnect('iRODS.Staging.Test', ('test', 'test-results'))
+
+    # and not wait much longer than the maximum wait, the DBs are tried at the same time
+    assert exc_info.value.code == ReturnCodes.DB_ERROR and time.monotonic() - start < 5
+
+
+class FakeCursor:
+    """
+    A DB cursor that records the statements run on its connection.
+
+    """
+
+    def __init__(self, conn):
+        # save the connection
+        self.conn = conn
+
+        # init the row to return
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql_stmt: str, params: tuple = None):
+        """
+        records the statement, failing it the way the connection was told to
+
+        :return:
+        """
+        # record the statement
+        self.conn.statements.append((sql_stmt, params))
+
+        # the server went away
+        if self.conn.fail == 'drop':
+            self.conn.closed = 2
+
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+        # the statement failed, the connection is fine
+        if self.conn.fail == 'error':
+            raise psycopg2.OperationalError('canceling statement due to statement timeout')
+
+        self.row = (1,)
+
+    def fetchone(self) -> tuple:
+        """
+        gets the row
+
+        :return:
+        """
+        return self.row
+
+
+class FakeConnection:
+    """
+    A DB connection that records what was done with it.
+
+    """
+
+    def __init__(self):
+        # init the connection state
+        self.closed: int = 0
+        self.autocommit: bool = True
+        self.commits: int = 0
+        self.fail: str = ''
+
+        # the statements run on the connection
+        self.statements: list = []
+
+        # the notifications received
+        self.notifies: list = []
+
+    def cursor(self) -> FakeCursor:
+        """
+        gets a cursor
+
+        :return:
+        """
+        return FakeCursor(self)
+
+    @staticmethod
+    def get_transaction_status() -> int:
+        """
+        gets the transaction status
+
+        :return:
+        """
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        """
+        counts the commits
+
+        :return:
+        """
+        self.commits += 1
+
+    def poll(self):
+        """
+        reads what arrived on the connection, failing the way the connection was told to
+
+        :return:
+        """
+        # the server went away
+        if self.fail == 'drop':
+            self.closed = 2
+
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def close(self):
+        """
+        closes the connection
+
+        :return:
+        """
+        self.closed = 1
+
+    def get_checks(self) -> int:
+        """
+        gets the number of connection checks done on the connection
+
+        :return:
+        """
+        return sum(1 for sql_stmt, _ in self.statements if sql_stmt == 'SELECT version()')
+
+
+def get_fake_db(monkeypatch, validation_ttl: str = '30', auto_commit: bool = True) -> tuple:
+    """
+    creates a DB object whose connections are fake connections
+
+    :return: The DB object and the list of the connections it made.
+    """
+    # set up the DB connection settings
+    for name, value in {'HOST': '127.0.0.1', 'PORT': '5432', 'DATABASE': 'test', 'USERNAME': 'test', 'PASSWORD': 'test'}.items():
+        monkeypatch.setenv(f'TEST_DB_{name}', value)
+
+    monkeypatch.setenv('DB_VALIDATION_TTL', validation_ttl)
+
+    # keep the connections made
+    conns: list = []
+
+    def connect(*_args, **_kwargs):
+        conns.append(FakeConnection())
+
+        return conns[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+
+    # return to the caller
+    return PGUtilsMultiConnect('iRODS.Staging.Test', ('test',), _auto_commit=auto_commit, _lazy_connect=True), conns
+
+
+def test_pool_validation(monkeypatch):
+    """
+    tests that pooled connections are only checked once they are idle longer than the validation TTL
+
+    :return:
+    """
+    # get the DB with a long TTL
+    db_info, conns = get_fake_db(monkeypatch)
+
+    # the connection is checked when it is made but not when it is reused
+    assert db_info.exec_sql('test', 'SELECT 1') == 1 and db_info.exec_sql('test', 'SELECT 1') == 1
+    assert len(conns) == 1 and conns[0].get_checks() == 1
+
+    # get the DB with no TTL
+    db_info, conns = get_fake_db(monkeypatch, '0')
+
+    # the connection is checked every time it is reused
+    assert db_info.exec_sql('test', 'SELECT 1') == 1 and db_info.exec_sql('test', 'SELECT 1') == 1
+    assert len(conns) == 1 and conns[0].get_checks() == 2
+
+    # a connection that fails the check is discarded and replaced
+    conns[0].fail = 'drop'
+
+    assert db_info.exec_sql('test', 'SELECT 1') == 1 and len(conns) == 2 and conns[0].closed
+
+
+def test_pool_retry(monkeypatch):
+    """
+    tests that statements are retried once on a new connection only if the connection was lost
+
+    :return:
+    """
+    # get the DB
+    db_info, conns = get_fake_db(monkeypatch)
+
+    # make the pooled connection
+    assert db_info.exec_sql('test', 'SELECT 1') == 1
+
+    # the server drops the trusted pooled connection, the statement is run again on a new one
+    conns[0].fail = 'drop'
+
+    assert db_info.exec_sql('test', 'SELECT 1') == 1 and len(conns) == 2
+
+    # a failed statement on a good connection is not retried and the connection goes back to the pool
+    conns[1].fail = 'error'
+
+    assert db_info.exec_sql('test', 'SELECT 1') == -1 and len(conns) == 2 and db_info.pools['test'][0].conn is conns[1]
+
+
+def test_pool_commit(monkeypatch):
+    """
+    tests that commit() commits the idle pooled connections and not those checked out
+
+    :return:
+    """
+    # get the DB without auto commit
+    db_info, conns = get_fake_db(monkeypatch, auto_commit=False)
+
+    # make two pooled connections
+    checked_out: list = [db_info.acquire_conn('test'), db_info.acquire_conn('test')]
+
+    for conn in checked_out:
+        db_info.release_conn('test', conn)
+
+    # check one out again
+    conn = db_info.acquire_conn('test')
+
+    # only the idle one is committed
+    db_info.commit('test')
+
+    assert len(conns) == 2 and conn.commits == 0 and [other for other in conns if other is not conn][0].commits == 1
+
+
+def test_unprepared_params(monkeypatch):
+    """
+    tests that $n placeholders are bound when a statement is run without a statement name
+
+    :return:
+    """
+    # get the DB
+    db_info, conns = get_fake_db(monkeypatch)
+
+    # the placeholders are converted and a literal percent sign is kept
+    assert db_info.exec_sql('test', "SELECT $1 || '%', $2, $1", ('a', 2)) == 1
+    assert conns[0].statements[-1] == ("SELECT %(1)s || '%%', %(2)s, %(1)s", {'1': 'a', '2': 2})
+
+    # a statement without parameters is left as is
+    assert db_info.exec_sql('test', "SELECT '%'") == 1 and conns[0].statements[-1] == ("SELECT '%'", None)
+
+
+def test_batch_params(monkeypatch):
+    """
+    tests renumbering the parameter placeholders of queries combined into one round trip
+
+    :return:
+    """
+    # get the DB
+    db_info, conns = get_fake_db(monkeypatch)
+
+    # combine the queries, the values of the single row are returned in query order
+    assert db_info.exec_sql_batch('test', [('SELECT f($1, $2)', ('a', 'b')), ('SELECT now()', None), ('SELECT g($2, $1)', ('c', 'd'))],
+                                  'batch') == [1]
+
+    # the placeholders of each query follow those of the queries before it
+    assert conns[0].statements[-2:] == [('PREPARE batch AS SELECT (SELECT f($1, $2)), (SELECT now()), (SELECT g($4, $3))', None),
+                                        ('EXECUTE batch (%s, %s, %s, %s)', ('a', 'b', 'c', 'd'))]
+
+
+def test_listen_notify(monkeypatch):
+    """
+    tests listening for notifications, losing the listening connection and not waiting past the time given to connect
+
+    :return:
+    """
+    # get the DB
+    db_info, conns = get_fake_db(monkeypatch)
+
+    # the fake connections are always readable
+    monkeypatch.setattr(select, 'select', lambda read, write, error, timeout: (read, [], []))
+
+    # subscribe to the channel on a connection that is not pooled
+    conn = db_info.listen('test', 'irods_sv_run_status')
+
+    assert conn is conns[0] and 'irods_sv_run_status' in repr(conn.statements[-1][0]) and not db_info.pools['test']
+
+    # the payloads are returned once
+    conn.notifies.extend([extensions.Notify(1, 'irods_sv_run_status', 'group-1'), extensions.Notify(1, 'irods_sv_run_status', '')])
+
+    assert db_info.wait_notify(conn, 1) == ['group-1', ''] and db_info.wait_notify(conn, 1) == []
+
+    # a lost connection is reported
+    conn.fail = 'drop'
+
+    assert db_info.wait_notify(conn, 1) is None
+
+    # the DB can not be reached
+    def connect(*_args, **_kwargs):
+        raise psycopg2.OperationalError('could not connect to server')
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+
+    # get the start time
+    start: float = time.monotonic()
+
+    # connecting gives up at the time given, not the DB_MAX_WAIT setting
+    assert db_info.listen('test', 'irods_sv_run_status', 0.5) is None and time.monotonic() - start < 2
@@ -0,0 +1,85 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Background deletion tests.
+
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from src.staging.reclaimer import Reclaimer, TOMBSTONE_DIR
+
+
+def test_bury_and_reclaim(tmp_path):
+    """
+    tests moving items out of the way and deleting them in the background
+
+    :return:
+    """
+    # create a run directory tree and a file to remove
+    for index in range(5):
+        os.makedirs(os.path.join(tmp_path, '1', f'dir-{index}', 'log'))
+
+        with open(os.path.join(tmp_path, '1', f'dir-{index}', 'log', 'rodsLog'), 'w', encoding='utf-8') as fp:
+            fp.write('log data')
+
+    with open(os.path.join(tmp_path, 'group.test-results.zip'), 'w', encoding='utf-8') as fp:
+        fp.write('old archive')
+
+    # create the reclaimer
+    reclaimer = Reclaimer(workers=2)
+
+    # bury the items, they must be gone from view right away. a missing item is not an error
+    assert reclaimer.bury(os.path.join(tmp_path, '1'), str(tmp_path))
+    assert reclaimer.bury(os.path.join(tmp_path, 'group.test-results.zip'), str(tmp_path))
+    assert not reclaimer.bury(os.path.join(tmp_path, '2'), str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == [TOMBSTONE_DIR] and len(os.listdir(os.path.join(tmp_path, TOMBSTONE_DIR))) == 2
+
+    # delete them in the background and wait for it to finish
+    reclaimer.reclaim(str(tmp_path))
+    reclaimer.wait(str(tmp_path))
+
+    # everything must be gone
+    assert not os.listdir(tmp_path)
+
+
+def test_concurrent_reclaim(tmp_path):
+    """
+    tests staging steps burying and reclaiming in the same run directory at once
+
+    :return:
+    """
+    # create the reclaimer
+    reclaimer = Reclaimer(workers=2)
+
+    def stage(index: int):
+        """
+        buries, reclaims and waits like a staging step
+
+        :param index: The staging step number.
+        :return:
+        """
+        for attempt in range(50):
+            # create some run data to remove
+            os.makedirs(os.path.join(tmp_path, f'{index}-{attempt}', 'PROVIDER'))
+
+            with open(os.path.join(tmp_path, f'{index}-{attempt}', 'PROVIDER', 'rodsLog'), 'w', encoding='utf-8') as fp:
+                fp.write('log data')
+
+            reclaimer.reclaim(str(tmp_path))
+            reclaimer.bury(os.path.join(tmp_path, f'{index}-{attempt}'), str(tmp_path))
+            reclaimer.reclaim(str(tmp_path))
+            reclaimer.wait(str(tmp_path))
+
+    # run the staging steps at once, none may fail
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(stage, index) for index in range(4)]:
+            future.result()
+
+    # a final pass removes anything buried after the last reclaim of another step
+    reclaimer.reclaim(str(tmp_path))
+    reclaimer.wait(str(tmp_path))
+
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,151 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Test results parser tests.
+
+"""
+import os
+import zipfile
+
+from src.staging.results import ResultsParser, DurationHistory, PREVIOUS_ATTEMPT_DIR
+
+
+def test_results_parsing(tmp_path):
+    """
+    tests summarizing the JUnit XML test reports of a run
+
+    :return:
+    """
+    # create the test report directory for an executor
+    report_dir: str = os.path.join(tmp_path, 'PROVIDER', 'test-reports')
+    os.makedirs(report_dir)
+
+    # write out a report with one test case of each status
+    with open(os.path.join(report_dir, 'TEST-test_ils.Test_Ils.xml'), 'w', encoding='utf-8') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<testsuite name="test_ils.Test_Ils" tests="4">\n'
+                 '  <testcase classname="test_ils.Test_Ils" name="test_pass" time="1.5"/>\n'
+                 '  <testcase classname="test_ils.Test_Ils" name="test_fail" time="2.25"><failure message="bad">trace</failure></testcase>\n'
+                 '  <testcase classname="test_ils.Test_Ils" name="test_error" time="0.25"><error message="bad">trace</error></testcase>\n'
+                 '  <testcase classname="test_ils.Test_Ils" name="test_skip" time="0"><skipped message="skip"/></testcase>\n'
+                 '</testsuite>\n')
+
+    # write out an invalid report, which must be skipped
+    with open(os.path.join(report_dir, 'TEST-broken.xml'), 'w', encoding='utf-8') as fp:
+        fp.write('<testsuite')
+
+    # parse the reports
+    results: dict = ResultsParser().get_run_results(str(tmp_path))
+
+    # check the summary and the per-test results
+    assert results['summary'] == {'total': 4, 'passed': 1, 'failed': 1, 'error': 1, 'skipped': 1, 'time': 4.0}
+    assert results['executors']['PROVIDER']['tests'][1] == ['test_ils.Test_Ils.test_fail', 'failed', 2.25]
+
+    # a run with no reports has no results
+    assert not ResultsParser().get_run_results(os.path.join(tmp_path, 'PROVIDER'))
+
+
+def test_duration_history(tmp_path):
+    """
+    tests keeping the historical test durations
+
+    :return:
+    """
+    # set up some run results
+    run_results: dict = {'executors': {'PROVIDER': {'tests': [['test_ils.Test_Ils.test_a', 'passed', 1.5],
+                                                              ['test_ils.Test_Ils.test_b', 'failed', 2.0],
+                                                              ['test_ils_extra.Test.test_c', 'passed', 9.0]]}}}
+
+    # a missing history file is an empty history
+    history = DurationHistory(os.path.join(tmp_path, 'durations.json'))
+
+    assert not history.durations
+
+    # update and save the history, a requested test with no results is left out
+    history.update(run_results, {'PROVIDER': ['test_ils', 'test_iput']})
+    history.save()
+
+    # reload it
+    assert DurationHistory(os.path.join(tmp_path, 'durations.json')).durations == {'PROVIDER': {'test_ils': 3.5}}
+
+
+def test_passed_tests(tmp_path):
+    """
+    tests finding the tests that passed in a previous attempt, from a run directory and from an archive
+
+    :return:
+    """
+    # create the test report directory for an executor of run 5
+    report_dir: str = os.path.join(tmp_path, '5', 'CONSUMER', 'test-reports')
+    os.makedirs(report_dir)
+
+    # write out a report where test_ils passed and test_iput failed
+    with open(os.path.join(report_dir, 'TEST-results.xml'), 'w', encoding='utf-8') as fp:
+        fp.write('<testsuites><testsuite name="s">'
+                 '<testcase classname="test_ils.Test_Ils" name="test_a" time="1"/>'
+                 '<testcase classname="test_ils.Test_Ils" name="test_b" time="1"><skipped/></testcase>'
+                 '<testcase classname="test_iput.Test_Iput" name="test_c" time="1"><failure/></testcase>'
+                 '<testcase classname="test_iput.Test_Iput" name="test_d" time="1"/>'
+                 '</testsuite></testsuites>')
+
+    # the requested tests, test_iget never ran
+    tests: dict = {'CONSUMER': ['test_ils', 'test_iput', 'test_iget']}
+
+    # get the results from the run directory
+    assert ResultsParser.get_passed_tests(ResultsParser().get_run_results(os.path.join(tmp_path, '5')), tests) == {'CONSUMER': {'test_ils'}}
+
+    # put the run results in a zip archive
+    with zipfile.ZipFile(os.path.join(tmp_path, 'group.test-results.zip'), 'w') as zip_file:
+        zip_file.write(os.path.join(report_dir, 'TEST-results.xml'), '5/CONSUMER/test-reports/TEST-results.xml')
+
+    # get the results from the archive, for this run only
+    archive_results: dict = ResultsParser().get_archive_results(os.path.join(tmp_path, 'group.test-results.zip'), '5')
+
+    assert ResultsParser.get_passed_tests(archive_results, tests) == {'CONSUMER': {'test_ils'}}
+    assert not ResultsParser().get_archive_results(os.path.join(tmp_path, 'group.test-results.zip'), '6')
+
+
+def test_previous_reports(tmp_path):
+    """
+    tests carrying the reports of the passed tests forward into a resumed run
+
+    :return:
+    """
+    # create the test report directory for an executor of run 5
+    report_dir: str = os.path.join(tmp_path, '5', 'CONSUMER', 'test-reports')
+    os.makedirs(report_dir)
+
+    # write out a report where test_ils passed and test_iput failed
+    with open(os.path.join(report_dir, 'TEST-results.xml'), 'w', encoding='utf-8') as fp:
+        fp.write('<testsuites tests="3" failures="1"><testsuite name="s" tests="3" failures="1" skipped="1">'
+                 '<testcase classname="test_ils.Test_Ils" name="test_a" time="1"/>'
+                 '<testcase classname="test_ils.Test_Ils" name="test_b" time="1"><skipped/></testcase>'
+                 '<testcase classname="test_iput.Test_Iput" name="test_c" time="1"><failure/></testcase>'
+                 '</testsuite></testsuites>')
+
+    # create the target class
+    results_parser = ResultsParser()
+
+    # keep the test cases of the passed tests
+    previous_reports: list = [(executor, report_name, results_parser.get_passed_report(fp, {'test_ils'}, report_name))
+                              for executor, report_name, fp in results_parser.get_run_reports(os.path.join(tmp_path, '5'))]
+
+    # a report with none of the passed tests is dropped
+    assert [results_parser.get_passed_report(fp, {'test_iget'}, report_name)
+            for _, report_name, fp in results_parser.get_run_reports(os.path.join(tmp_path, '5'))] == [None]
+
+    # write them into the new run directory
+    results_parser.write_previous_reports(os.path.join(tmp_path, 'new'), previous_reports)
+
+    # only the passed test cases are carried forward
+    results: dict = results_parser.get_run_results(os.path.join(tmp_path, 'new'))
+
+    assert results['summary'] == {'total': 2, 'passed': 1, 'failed': 0, 'error': 0, 'skipped': 1, 'time': 2.0}
+
+    # and the suite counts match them
+    with open(os.path.join(tmp_path, 'new', 'CONSUMER', PREVIOUS_ATTEMPT_DIR, 'test-reports', 'TEST-results.xml'), 'r', encoding='utf-8') as fp:
+        report: str = fp.read()
+
+    assert '<testsuites tests="2" failures="0">' in report and '<testsuite name="s" tests="2" failures="0" skipped="1">' in report
@@ -0,0 +1,50 @@
+# BSD 3-Clause All rights reserved.
+#
+# SPDX-License-Identifier: BSD 3-Clause
+
+"""
+    Staging service tests.
+
+"""
+import os
+import threading
+
+from src.staging.staging import Staging
+from src.staging.service import StagingService, post_stage_request
+from src.common.staging_enums import ReturnCodes
+
+
+def test_service_requests(tmp_path):
+    """
+    tests handing staging steps to the staging service.
+
+    this test requires that DB connection parameters are set
+
+    :return:
+    """
+    # start the service on a free port
+    service = StagingService(Staging(), '127.0.0.1', 0)
+
+    threading.Thread(target=service.serve_forever, daemon=True).start()
+
+    try:
+        # get the service URL
+        service_url: str = f'http://127.0.0.1:{service.server_address[1]}'
+
+        # an invalid step type is rejected
+        assert post_stage_request(service_url, {'run_id': '1', 'run_dir': str(tmp_path), 'step_type': 'bogus'})['ret_val'] == -2
+
+        # as is a missing param
+        assert post_stage_request(service_url, {'run_id': '1', 'step_type': 'final'})['ret_val'] == -3
+
+        # a final stage of a missing run directory is processed and fails
+        assert post_stage_request(service_url, {'run_id': '1', 'run_dir': os.path.join(tmp_path, 'missing'), 'step_type': 'final'})['ret_val'] == \
+            ReturnCodes.ERROR_NO_RUN_DIR
+
+        # a batch of runs reports each run
+        assert post_stage_request(service_url, {'run_ids': ['1', '2'], 'run_dir': os.path.join(tmp_path, 'missing'), 'step_type': 'final'}) == \
+            {'ret_val': ReturnCodes.ERROR_NO_RUN_DIR, 'results': {'1': ReturnCodes.ERROR_NO_RUN_DIR, '2': ReturnCodes.ERROR_NO_RUN_DIR}}
+    finally:
+        # stop the service
+        service.shutdown()
+        service.server_close()
@@ -8,7 +8,17 @@
     Author: Phil Owen, RENCI.org
 """
 import os
-from src.staging.staging import Staging
+import socket
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.staging.staging import Staging, RUN_DEF_CACHE_DIR
+from src.staging.archiver import MEMBER_ARCHIVE_DIR
+from src.staging.results import ResultsParser
+from src.staging.journal import StagingJournal, PUBLISHED_DIR, get_journal_file, is_published, mark_published
 from src.common.staging_enums import StagingType, WorkflowTypeName, ReturnCodes
 
 
@@ -161,3 +171,610 @@ def test_file_creation():
 
     # check the result
     assert ret_val == ReturnCodes.EXIT_CODE_SUCCESS and os.path.isfile(os.path.join(os.path.dirname(__file__), 'CONSUMER_test_list.sh'))
+
+    # clear out the previous results
+    for executor in ['PROVIDER', 'CONSUMER']:
+        os.unlink(os.path.join(os.path.dirname(__file__), f'{executor}_test_list.sh'))
+
+    # create a topology test list with tests declared for multiple executors
+    run_data: dict = {"id": 3, "status": "New run accepted for save-this-test-1",
+                      "request_data": {"workflow-type": "TOPOLOGY", "db-image": "postgres:14.11", "db-type": "postgres",
+                                       "os-image": "irods-ubuntu-20.04:latest",
+                                       "package-dir": "/projects/irods/github-build-artifacts/3957adb/ubuntu:20.04",
+                                       "tests": {"PROVIDER": ["test_ihelp"], "CONSUMER": ["test_ils"]}}, "request_group": "save-this-test-1"}
+
+    # make the call
+    ret_val = staging.create_test_files(os.path.dirname(__file__), run_data, WorkflowTypeName.TOPOLOGY)
+
+    # every executor must get a file
+    assert ret_val == ReturnCodes.EXIT_CODE_SUCCESS and all(os.path.isfile(os.path.join(os.path.dirname(__file__), f'{executor}_test_list.sh'))
+                                                            for executor in ['PROVIDER', 'CONSUMER'])
+
+    # do not leave the generated files behind
+    for executor in ['PROVIDER', 'CONSUMER']:
+        os.unlink(os.path.join(os.path.dirname(__file__), f'{executor}_test_list.sh'))
+
+
+def test_test_sharding():
+    """
+    tests splitting the requested tests into shards
+
+    :return:
+    """
+    # set up the tests and their historical durations
+    tests: list = ['test_a', 'test_b', 'test_c', 'test_d', 'test_e', 'test_f']
+    durations: dict = {'test_a': 100.0, 'test_b': 60.0, 'test_c': 50.0, 'test_d': 40.0, 'test_e': 10.0}
+
+    # split the tests by duration, test_f gets the average duration
+    shards: list = Staging.shard_tests(tests, 2, durations)
+
+    # every test is run once, in the requested order within each shard
+    assert sorted(test for shard in shards for test in shard) == tests and all(shard == sorted(shard) for shard in shards)
+
+    # the shards are balanced by duration: 100 + 50 + 10 and 60 + 52 + 40
+    assert [sum(durations.get(test, 52.0) for test in shard) for shard in shards] == [160.0, 152.0]
+
+    # with no history the split is balanced by count
+    assert [len(shard) for shard in Staging.shard_tests(tests, 4, {})] == [2, 2, 1, 1]
+
+    # there can not be more shards than tests
+    assert len(Staging.shard_tests(tests[:2], 4, {})) == 2
+
+
+def test_test_file_commands(tmp_path):
+    """
+    tests that each test gets its own test command and progress message
+
+    this test requires that DB connection parameters are set
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    # write out 3 tests
+    staging.write_test_file(os.path.join(tmp_path, 'PROVIDER_test_list.sh'), ['test_a', 'test_b', 'test_c'], 'python3 run_tests.py',
+                            '/data/1/PROVIDER')
+
+    with open(os.path.join(tmp_path, 'PROVIDER_test_list.sh'), 'r', encoding='utf-8') as fp:
+        lines: list = fp.read().splitlines()
+
+    # each test command takes one test and is preceded by its progress message
+    assert lines[2:5] == [f'echo "Running {test}"; python3 run_tests.py --run_s {test};' for test in ('test_a', 'test_b', 'test_c')]
+
+    # the results are saved once after the tests
+    assert lines[5] == 'echo "Creating the run results dir /data/1/PROVIDER..."; mkdir -p /data/1/PROVIDER;'
+
+
+def test_final_staging_db_error(tmp_path, monkeypatch):
+    """
+    tests that final staging reports a DB error so the step is rescheduled, with and without the cached run definition
+
+    :return:
+    """
+    # get a local port that nothing is listening on
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port: int = sock.getsockname()[1]
+
+    # point the DB connection at it and use short retry settings
+    for name, value in {'IRODS_SV_DB_HOST': '127.0.0.1', 'IRODS_SV_DB_PORT': str(port), 'DB_CONNECT_TIMEOUT': '1', 'DB_RETRY_BASE': '0.1',
+                        'DB_RETRY_CAP': '0.2', 'DB_MAX_WAIT': '0.5'}.items():
+        monkeypatch.setenv(name, value)
+
+    # create the target class
+    staging = Staging()
+
+    # create the run directory
+    os.makedirs(os.path.join(tmp_path, '9'))
+
+    # the run definition has to come from the DB
+    assert staging.final_staging('9', str(tmp_path), StagingType.FINAL_STAGING) == ReturnCodes.DB_ERROR
+
+    # the run status has to come from the DB
+    staging.save_run_def(str(tmp_path), '9', {'id': 9, 'request_group': 'group-9', 'request_data': {'package-dir': ''}})
+
+    assert staging.final_staging('9', str(tmp_path), StagingType.FINAL_STAGING) == ReturnCodes.DB_ERROR
+
+
+def test_run_def_cache(tmp_path):
+    """
+    tests caching the run definition between staging steps.
+
+    this test requires that DB connection parameters are set
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    # set up a run definition
+    run_data: dict = {'id': 5, 'request_group': 'group-5', 'request_data': {'package-dir': '', 'tests': {'PROVIDER': ['test_ils']}}}
+
+    # cache it and read it back
+    staging.save_run_def(str(tmp_path), '5', run_data)
+
+    assert staging.load_run_def(str(tmp_path), '5') == run_data
+
+    # a missing cache is not usable
+    assert staging.load_run_def(str(tmp_path), '6') is None
+
+    # neither is a modified one
+    cache_file: str = os.path.join(tmp_path, RUN_DEF_CACHE_DIR, '5.json')
+
+    with open(cache_file, 'r', encoding='utf-8') as fp:
+        cache: str = fp.read()
+
+    with open(cache_file, 'w', encoding='utf-8') as fp:
+        fp.write(cache.replace('group-5', 'group-6'))
+
+    assert staging.load_run_def(str(tmp_path), '5') is None
+
+
+def lock_run_groups(monkeypatch, staging: Staging, held_by_peer: bool = False) -> list:
+    """
+    replaces the request group archive lock so that the tests do not need the DB.
+
+    :param monkeypatch: The pytest monkeypatch fixture.
+    :param staging: The staging class to patch.
+    :param held_by_peer: True if a peer holds the lock.
+
+    :return: The request groups that were unlocked.
+    """
+    # init the return value
+    unlocked: list = []
+
+    # a peer holding the lock is reported as False, the holder gets its connection
+    monkeypatch.setattr(staging.db_info, 'try_lock_run_group', lambda request_group: False if held_by_peer else object())
+    monkeypatch.setattr(staging.db_info, 'unlock_run_group', lambda request_group, conn: unlocked.append(request_group))
+
+    # return to the caller
+    return unlocked
+
+
+def test_final_staging_resume(tmp_path, monkeypatch):
+    """
+    tests picking up the archiving of a request group after an interrupted final staging step.
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    unlocked: list = lock_run_groups(monkeypatch, staging)
+
+    # set up a run directory with some results
+    run_dir: str = str(tmp_path / 'runs')
+
+    os.makedirs(os.path.join(run_dir, '7', 'PROVIDER'))
+
+    with open(os.path.join(run_dir, '7', 'PROVIDER', 'test_ils.log'), 'w', encoding='utf-8') as fp:
+        fp.write('test output')
+
+    # use a package directory that is not there yet so the copy fails
+    package_dir: str = str(tmp_path / 'package')
+
+    run_data: dict = {'id': 7, 'request_group': 'group-7', 'request_data': {'package-dir': package_dir}}
+
+    # the run definition cached by initial staging
+    staging.save_run_def(run_dir, '7', run_data)
+
+    # create the archive builder
+    archive_builder = staging.archive_settings.create_builder(_logger=staging.logger)
+
+    # the step is interrupted after building the k8s archive
+    with pytest.raises(OSError):
+        staging.archive_run_group(run_dir, run_data, archive_builder)
+
+    # the journal records the archive
+    journal = StagingJournal(get_journal_file(run_dir, 'group-7'))
+
+    assert journal.is_done('archive_k8s') and not journal.is_done('archive_nfs')
+
+    # get the archive build time
+    archive_file: str = journal.get('archive_k8s')['archive_file']
+
+    build_time: int = os.stat(archive_file).st_mtime_ns
+
+    # the re-run finds the journal, even without the run directory
+    os.makedirs(package_dir)
+
+    assert staging.resume_run_group(run_dir, os.path.join(run_dir, '8')) == ReturnCodes.EXIT_CODE_SUCCESS
+
+    # the archive was copied without being built again and the journal is gone
+    assert os.path.isfile(os.path.join(package_dir, os.path.basename(archive_file))) and os.stat(archive_file).st_mtime_ns == build_time
+    assert not os.path.exists(journal.journal_file) and unlocked == ['group-7']
+
+    # with nothing to pick up the run directory is missing
+    assert staging.resume_run_group(run_dir, os.path.join(run_dir, '8')) == ReturnCodes.ERROR_NO_RUN_DIR
+
+
+def test_published_markers(tmp_path):
+    """
+    tests that the final staging steps of a request group record their published results without losing each other's.
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    # set up a run directory with the results of a few runs
+    run_dir: str = str(tmp_path / 'runs')
+
+    for run_id in range(8):
+        os.makedirs(os.path.join(run_dir, str(run_id), 'PROVIDER'))
+
+        with open(os.path.join(run_dir, str(run_id), 'PROVIDER', 'test_ils.log'), 'w', encoding='utf-8') as fp:
+            fp.write('test output')
+
+    # the steps publish at the same time
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda run_id: mark_published(run_dir, str(run_id), {'passed': run_id}), range(8)))
+
+    # none of them were lost
+    assert all(is_published(run_dir, str(run_id)) for run_id in range(8))
+
+    run_data: dict = {'id': 0, 'request_group': 'group-9', 'request_data': {'package-dir': ''}}
+
+    # archive the request group
+    staging.archive_run_group(run_dir, run_data, staging.archive_settings.create_builder(_logger=staging.logger))
+    staging.reclaimer.wait(run_dir)
+
+    # the markers are not archived and are removed with the run directories
+    with zipfile.ZipFile(os.path.join(run_dir, 'group-9.test-results.zip')) as zip_file:
+        assert not any(PUBLISHED_DIR in name for name in zip_file.namelist())
+
+    assert not os.path.exists(os.path.join(run_dir, PUBLISHED_DIR))
+
+
+def test_publish_peers(tmp_path, monkeypatch):
+    """
+    tests that the runs of a request group that did not publish their results are published before the run directories are removed.
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    # set up a run directory with a run that published its results and one that did not
+    run_dir: str = str(tmp_path / 'runs')
+
+    for run_id in ('1', '2'):
+        os.makedirs(os.path.join(run_dir, run_id, 'PROVIDER', 'test-reports'))
+
+        with open(os.path.join(run_dir, run_id, 'PROVIDER', 'test-reports', 'TEST-results.xml'), 'w', encoding='utf-8') as fp:
+            fp.write('<testsuite name="test_ils.Test_Ils" tests="1"><testcase classname="test_ils.Test_Ils" name="test_pass" time="1"/></testsuite>')
+
+    run_data: dict = {'id': 1, 'request_group': 'group-10', 'request_data': {'package-dir': ''}}
+
+    staging.save_run_def(run_dir, '2', dict(run_data, id=2))
+
+    mark_published(run_dir, '1', {})
+
+    # the DB can not be reached
+    monkeypatch.setattr(staging.db_info, 'update_run_results', lambda run_id, results: ReturnCodes.DB_ERROR)
+
+    # the group is not archived and the results are kept
+    assert staging.archive_run_group(run_dir, run_data, staging.archive_settings.create_builder(_logger=staging.logger)) == ReturnCodes.DB_ERROR
+    assert os.path.isdir(os.path.join(run_dir, '2')) and not os.path.exists(os.path.join(run_dir, 'group-10.test-results.zip'))
+
+    # keep the published results
+    published: dict = {}
+
+    monkeypatch.setattr(staging.db_info, 'update_run_results', published.__setitem__)
+
+    # the results of the peer are published before the group is archived
+    assert staging.archive_run_group(run_dir, run_data, staging.archive_settings.create_builder(_logger=staging.logger)) == \
+           ReturnCodes.EXIT_CODE_SUCCESS
+    assert list(published) == ['2'] and published['2']['summary']['passed'] == 1
+
+    staging.reclaimer.wait(run_dir)
+
+    assert os.path.isfile(os.path.join(run_dir, 'group-10.test-results.zip')) and not os.path.exists(os.path.join(run_dir, '2'))
+
+
+def test_run_batch_archive(tmp_path, monkeypatch):
+    """
+    tests that a final staging batch archives the request group with a run whose directory is still there.
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    unlocked: list = lock_run_groups(monkeypatch, staging)
+
+    # set up a run directory with the results of two runs, the last run of the batch has no directory
+    run_dir: str = str(tmp_path / 'runs')
+
+    for run_id in ('1', '2'):
+        os.makedirs(os.path.join(run_dir, run_id, 'PROVIDER', 'test-reports'))
+
+        with open(os.path.join(run_dir, run_id, 'PROVIDER', 'test-reports', 'TEST-results.xml'), 'w', encoding='utf-8') as fp:
+            fp.write('<testsuite name="test_ils.Test_Ils" tests="1"><testcase classname="test_ils.Test_Ils" name="test_pass" time="1"/></testsuite>')
+
+        staging.save_run_def(run_dir, run_id, {'id': int(run_id), 'request_group': 'group-11', 'request_data': {'package-dir': ''}})
+
+    # keep the published results of the complete request group
+    published: dict = {}
+
+    monkeypatch.setattr(staging.db_info, 'update_run_results', published.__setitem__)
+    monkeypatch.setattr(staging.db_info, 'is_run_group_complete', lambda request_group: True)
+
+    # stage the batch
+    ret_val: dict = staging.run_batch(['1', '2', '3'], run_dir, StagingType.FINAL_STAGING)
+
+    assert ret_val == {'1': ReturnCodes.EXIT_CODE_SUCCESS, '2': ReturnCodes.EXIT_CODE_SUCCESS, '3': ReturnCodes.ERROR_NO_RUN_DIR}
+
+    # both runs were published and the request group was archived
+    assert sorted(published) == ['1', '2'] and os.path.isfile(os.path.join(run_dir, 'group-11.test-results.zip'))
+    assert not os.path.exists(os.path.join(run_dir, '1')) and not os.path.exists(os.path.join(run_dir, '2')) and unlocked == ['group-11']
+
+
+def test_archive_run_group_once(tmp_path, monkeypatch):
+    """
+    tests that only the final staging step holding the request group lock archives the group.
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    # set up a run directory with some results
+    run_dir: str = str(tmp_path / 'runs')
+
+    os.makedirs(os.path.join(run_dir, '16', 'PROVIDER'))
+
+    with open(os.path.join(run_dir, '16', 'PROVIDER', 'test_ils.log'), 'w', encoding='utf-8') as fp:
+        fp.write('test output')
+
+    run_data: dict = {'id': 16, 'request_group': 'group-16', 'request_data': {'package-dir': ''}}
+
+    mark_published(run_dir, '16', {})
+
+    archive_file: str = os.path.join(run_dir, 'group-16.test-results.zip')
+
+    # a peer holds the lock
+    unlocked: list = lock_run_groups(monkeypatch, staging, held_by_peer=True)
+
+    assert staging.archive_run_group_once(run_dir, os.path.join(run_dir, '16'), run_data,
+                                          staging.archive_settings.create_builder(_logger=staging.logger)) == ReturnCodes.HANDLED_BY_PEER
+
+    # nothing was archived and the lock was not released
+    assert not os.path.exists(archive_file) and os.path.isdir(os.path.join(run_dir, '16')) and not unlocked
+
+    # the lock can not be taken
+    monkeypatch.setattr(staging.db_info, 'try_lock_run_group', lambda request_group: None)
+
+    assert staging.archive_run_group_once(run_dir, os.path.join(run_dir, '16'), run_data,
+                                          staging.archive_settings.create_builder(_logger=staging.logger)) == ReturnCodes.DB_ERROR
+    assert not os.path.exists(archive_file) and not unlocked
+
+    # the lock holder archives the group and releases the lock
+    unlocked = lock_run_groups(monkeypatch, staging)
+
+    assert staging.archive_run_group_once(run_dir, os.path.join(run_dir, '16'), run_data,
+                                          staging.archive_settings.create_builder(_logger=staging.logger)) == ReturnCodes.EXIT_CODE_SUCCESS
+
+    staging.reclaimer.wait(run_dir)
+
+    assert os.path.isfile(archive_file) and not os.path.exists(os.path.join(run_dir, '16')) and unlocked == ['group-16']
+
+    # a step that takes the lock after the group was archived leaves it alone
+    build_time: int = os.stat(archive_file).st_mtime_ns
+
+    assert staging.archive_run_group_once(run_dir, os.path.join(run_dir, '16'), run_data,
+                                          staging.archive_settings.create_builder(_logger=staging.logger)) == ReturnCodes.HANDLED_BY_PEER
+    assert os.stat(archive_file).st_mtime_ns == build_time and unlocked == ['group-16', 'group-16']
+
+
+def test_resume_from_archive(tmp_path, monkeypatch):
+    """
+    tests that each run of an archived request group resumes from the group's results archive.
+
+    :return:
+    """
+    # create the target class
+    staging = Staging()
+
+    # set up a run directory with two runs where test_ils passed and test_iput failed
+    run_dir: str = str(tmp_path / 'runs')
+
+    run_defs: dict = {}
+
+    for run_id in ('1', '2'):
+        os.makedirs(os.path.join(run_dir, run_id, 'PROVIDER', 'test-reports'))
+
+        with open(os.path.join(run_dir, run_id, 'PROVIDER', 'test-reports', 'TEST-results.xml'), 'w', encoding='utf-8') as fp:
+            fp.write('<testsuite name="s" tests="2"><testcase classname="test_ils.Test_Ils" name="test_a" time="1"/>'
+                     '<testcase classname="test_iput.Test_Iput" name="test_b" time="1"><failure/></testcase></testsuite>')
+
+        run_defs[run_id] = {'id': int(run_id), 'request_group': 'group-12',
+                            'request_data': {'package-dir': '', 'resume': True, 'tests': {'PROVIDER': ['test_ils', 'test_iput']}}}
+
+        mark_published(run_dir, run_id, {})
+
+    # archive the request group, which removes the run directories
+    assert staging.archive_run_group(run_dir, run_defs['1'], staging.archive_settings.create_builder(_logger=staging.logger)) == \
+           ReturnCodes.EXIT_CODE_SUCCESS
+
+    staging.reclaimer.wait(run_dir)
+
+    # the run definitions come from the DB
+    monkeypatch.setattr(staging.db_info, 'get_run_def', run_defs.get)
+    monkeypatch.setattr(staging.db_info, 'update_run_results', lambda run_id, results: ReturnCodes.EXIT_CODE_SUCCESS)
+
+    # resume both runs of the group
+    for run_id in ('1', '2'):
+        assert staging.initial_staging(run_id, run_dir, StagingType.INITIAL_STAGING, WorkflowTypeName.CORE) == ReturnCodes.EXIT_CODE_SUCCESS
+
+        # only the failed test is run again
+        with open(os.path.join(run_dir, run_id, 'PROVIDER_test_list.sh'), 'r', encoding='utf-8') as fp:
+            test_file: str = fp.read()
+
+        assert 'test_iput' in test_file and 'test_ils' not in test_file
+
+        # and the passed test is carried forward
+        assert ResultsParser().get_run_results(os.path.join(run_dir, run_id))['summary']['passed'] == 1
+
+    # the group archive is replaced when the group is archived again
+    staging.archive_run_group(run_dir, run_defs['1'], staging.archive_settings.create_builder(_logger=staging.logger))
+    staging.reclaimer.wait(run_dir)
+
+    with zipfile.ZipFile(os.path.join(run_dir, 'group-12.test-results.zip')) as zip_file:
+        assert not any(name.endswith('.zip') for name in zip_file.namelist())
+
+
+class FakeNotifier:
+    """
+    A run status source that delivers scripted notifications and records what the wait did with them.
+
+    """
+
+    def __init__(self, payloads: list, complete_after: int = None):
+        # the payloads of each wait, None for a lost connection
+        self.payloads: list = payloads
+
+        # the number of status checks after which the request group is complete, None for never
+        self.complete_after: int = complete_after
+
+        # init what was done
+        self.listens: list = []
+        self.discarded: list = []
+        self.checks: list = []
+
+    def listen(self, _db_name: str, _channel: str, max_wait: float = None):
+        """
+        records the subscription, returning a new connection
+
+        :return:
+        """
+        self.listens.append(max_wait)
+
+        return f'conn-{len(self.listens)}'
+
+    def wait_notify(self, _conn, timeout: float):
+        """
+        returns the next scripted payloads, or waits out the timeout once they run out
+
+        :return:
+        """
+        if self.payloads:
+            time.sleep(0.01)
+
+            return self.payloads.pop(0)
+
+        time.sleep(max(0.0, timeout))
+
+        return []
+
+    def discard_conn(self, conn):
+        """
+        records the closed connection
+
+        :return:
+        """
+        self.discarded.append(conn)
+
+    def is_run_group_complete(self, _request_group: str) -> bool:
+        """
+        records the status check
+
+        :return:
+        """
+        self.checks.append(time.monotonic())
+
+        return self.complete_after is not None and len(self.checks) >= self.complete_after
+
+
+def get_waiting_staging(monkeypatch, notifier: FakeNotifier, wait_timeout: float, recheck_interval: float) -> Staging:
+    """
+    creates a staging object that waits on a fake run status source
+
+    :return: The staging object.
+    """
+    # create the target class
+    staging = Staging()
+
+    # set the wait times
+    staging.final_staging_settings.wait_timeout = wait_timeout
+    staging.final_staging_settings.recheck_interval = recheck_interval
+
+    # use the fake run status source
+    for name in ('listen', 'wait_notify', 'discard_conn', 'is_run_group_complete'):
+        monkeypatch.setattr(staging.db_info, name, getattr(notifier, name))
+
+    # return to the caller
+    return staging
+
+
+def test_wait_for_run_group(monkeypatch):
+    """
+    tests waiting for the other runs of a request group to complete
+
+    :return:
+    """
+    # a notification for the request group is checked at once
+    notifier = FakeNotifier([['group-13']], 2)
+
+    assert get_waiting_staging(monkeypatch, notifier, 5, 60).wait_for_run_group('group-13') and len(notifier.checks) == 2
+    assert notifier.discarded == ['conn-1']
+
+    # notifications for other request groups are ignored until the recheck
+    notifier = FakeNotifier([['group-14']] * 20, 2)
+
+    assert get_waiting_staging(monkeypatch, notifier, 5, 0.3).wait_for_run_group('group-13')
+    assert len(notifier.checks) == 2 and notifier.checks[1] - notifier.checks[0] >= 0.3
+
+    # a lost connection is listened to again
+    notifier = FakeNotifier([None, ['group-13']], 4)
+
+    assert get_waiting_staging(monkeypatch, notifier, 5, 60).wait_for_run_group('group-13')
+    assert len(notifier.listens) == 2 and notifier.discarded == ['conn-1', 'conn-2']
+
+    # the wait gives up at the timeout, connecting again included
+    notifier = FakeNotifier([None] * 5)
+
+    # get the start time
+    start: float = time.monotonic()
+
+    assert not get_waiting_staging(monkeypatch, notifier, 0.5, 60).wait_for_run_group('group-13') and time.monotonic() - start < 1
+    assert notifier.listens and all(max_wait <= 0.5 for max_wait in notifier.listens)
+
+
+def test_incremental_after_archive(tmp_path, monkeypatch):
+    """
+    tests that an interrupted final staging step does not compress the run's results again once the group archive is built.
+
+    :return:
+    """
+    # create the target class in incremental mode
+    staging = Staging()
+
+    staging.archive_settings.incremental = True
+
+    # set up a run directory with some results
+    run_dir: str = str(tmp_path / 'runs')
+
+    os.makedirs(os.path.join(run_dir, '15', 'PROVIDER'))
+
+    with open(os.path.join(run_dir, '15', 'PROVIDER', 'test_ils.log'), 'w', encoding='utf-8') as fp:
+        fp.write('test output')
+
+    staging.save_run_def(run_dir, '15', {'id': 15, 'request_group': 'group-15', 'request_data': {'package-dir': ''}})
+
+    # the rest of the request group is still running
+    monkeypatch.setattr(staging.db_info, 'is_run_group_complete', lambda request_group: False)
+
+    # the run's results are compressed
+    assert staging.final_staging('15', run_dir, StagingType.FINAL_STAGING) == ReturnCodes.EXIT_CODE_SUCCESS
+    assert os.listdir(os.path.join(run_dir, MEMBER_ARCHIVE_DIR)) == ['15.PROVIDER.zip']
+
+    # an interrupted step built the group archive and removed the member archives
+    StagingJournal(get_journal_file(run_dir, 'group-15')).mark_done('archive_k8s', archive_file='', request_group='group-15', package_dir='')
+
+    os.unlink(os.path.join(run_dir, MEMBER_ARCHIVE_DIR, '15.PROVIDER.zip'))
+
+    # they are not built again
+    assert staging.final_staging('15', run_dir, StagingType.FINAL_STAGING) == ReturnCodes.EXIT_CODE_SUCCESS
+    assert not os.listdir(os.path.join(run_dir, MEMBER_ARCHIVE_DIR))